@@ -0,0 +1,235 @@
+"""
+Replay menu requests against the bot offline using a local menu website and a fake Slack client.
+
+Reports the menu update cycle duration, the `parse_pdf` time, the time spent in `process_message`, the reply latency
+until the reply is posted to Slack, and the peak memory usage of the bot and of its parse worker processes.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_load [--events 5000] [--channels 200] [--cycles 5] [--tracemalloc]
+"""
+import argparse
+import collections
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from benchmarks.fake_slack import FakeSlackClient
+from benchmarks.menu_site import MenuSite
+from plugins import komida_parser
+from plugins.komida_bot import KomidaPlugin
+from plugins.komida_metrics import metrics
+from plugins.komida_update import CAMPUSES
+
+
+CAMPUS_TEXTS = ['', '', '', 'cmi', 'cde', 'cst', 'middelheim', 'drie eiken', 'stad', 'cmi cde']
+DATE_TEXTS = ['', '', '', 'today', 'tomorrow', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday']
+SEARCH_TEXTS = ['when is there lasagne?', 'which campus has vol-au-vent this week', 'search stoofvlees at cmi']
+
+
+def make_events(count, channels, seed=0):
+    """
+    Generate Slack message events with a mix of menu requests, 'lunch!' triggers, dish searches, and direct messages.
+
+    Args:
+        count: The number of events.
+        channels: The number of distinct channels.
+        seed: The random seed.
+
+    Returns:
+        A list of Slack message events.
+    """
+    rng = random.Random(seed)
+    events = []
+    for _ in range(count):
+        r = rng.random()
+        if r < 0.3:
+            text = 'lunch!'
+        elif r < 0.9:
+            text = ' '.join(['komidabot', rng.choice(CAMPUS_TEXTS), rng.choice(DATE_TEXTS)]).strip()
+        else:
+            text = 'komidabot {}'.format(rng.choice(SEARCH_TEXTS))
+        # some requests are direct messages
+        channel = '{}{:08d}'.format('D' if rng.random() < 0.1 else 'C', rng.randrange(channels))
+        events.append({'type': 'message', 'channel': channel, 'user': 'U{:04d}'.format(rng.randrange(1000)),
+                       'text': text})
+
+    return events
+
+
+class ReplyTracker:
+
+    def __init__(self, sender):
+        """
+        Record the messages that are queued by the `SlackSender` together with the time of the request they reply to.
+
+        Args:
+            sender: The `SlackSender` whose messages are recorded.
+        """
+        self.queued = collections.defaultdict(list)
+        self.request = threading.local()
+
+        self._lock = threading.Lock()
+        self._send = sender.send
+        sender.send = self.send
+
+    def send(self, channel, *args, **kwargs):
+        # messages that are queued outside of a request, such as replies after a menu update, are recorded without time
+        with self._lock:
+            queued = self._send(channel, *args, **kwargs)
+            if queued:
+                self.queued[channel].append(getattr(self.request, 'start', None))
+        return queued
+
+    def latencies(self, calls):
+        """
+        Match the posted messages to the queued messages to get the time from each request until its reply was posted.
+
+        The messages to each channel are posted in the order in which they were queued.
+
+        Args:
+            calls: The API calls recorded by the `FakeSlackClient`.
+
+        Returns:
+            A list of the reply latencies in seconds.
+        """
+        posted = collections.defaultdict(list)
+        for timestamp, method, kwargs in calls:
+            if method == 'chat.postMessage':
+                posted[kwargs['channel']].append(timestamp)
+        return [post - start for channel, starts in self.queued.items()
+                for start, post in zip(starts, posted[channel]) if start is not None]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def format_timings(timings):
+    return 'min {:8.2f} ms, mean {:8.2f} ms'.format(min(timings) * 1000, sum(timings) / len(timings) * 1000)
+
+
+def bench_update(site, cycles):
+    """
+    Measure the duration of the menu update cycles.
+    """
+    print('update cycle (cold):         {}'.format(format_timings([timed(komida_parser.update_menus, CAMPUSES)])))
+    print('update cycle (not modified): {}'.format(format_timings(
+        [timed(komida_parser.update_menus, CAMPUSES) for _ in range(cycles)])))
+    timings = []
+    for i in range(cycles):
+        for campus in CAMPUSES:
+            site.publish(campus, seed=i + 1)
+        timings.append(timed(komida_parser.update_menus, CAMPUSES))
+    print('update cycle (modified):     {}'.format(format_timings(timings)))
+
+
+def bench_parse(site, directory, repeat):
+    """
+    Measure the duration of `parse_pdf` on a menu PDF.
+    """
+    path = os.path.join(directory, 'menu.pdf')
+    with open(path, 'wb') as f:
+        f.write(site.pdfs['cmi'])
+    print('parse_pdf:                   {}'.format(format_timings(
+        [timed(komida_parser.parse_pdf_file, path, 'cmi') for _ in range(repeat)])))
+
+
+def print_latencies(label, latencies):
+    print('{:<29}p50 {:8.3f} ms, p99 {:8.3f} ms, max {:8.3f} ms'.format(
+        label + ':', percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+
+
+def bench_requests(plugin, slack_client, events):
+    """
+    Measure the time spent in `process_message`, the reply latency until each reply is posted to Slack, and the time
+    until all replies have been posted.
+    """
+    tracker = ReplyTracker(plugin.sender)
+    handling = []
+    start = time.perf_counter()
+    for event in events:
+        tracker.request.start = time.perf_counter()
+        handling.append(timed(plugin.process_message, event))
+        tracker.request.start = None
+    duration = time.perf_counter() - start
+    print('{} requests in {:.2f} s ({:.0f} requests/s)'.format(len(events), duration, len(events) / duration))
+    print_latencies('request handling', handling)
+
+    # replies are posted by the `SlackSender` thread, including throttling and queueing delays
+    posts = slack_client.wait_idle()
+    latencies = tracker.latencies(slack_client.calls)
+    if len(latencies) > 0:
+        print_latencies('reply latency', latencies)
+    if posts > 0:
+        print('{} messages posted to Slack, the last one after {:.2f} s'.format(
+            posts, slack_client.calls[-1][0] - start))
+
+
+def print_stages():
+    """
+    Print the mean duration of each stage recorded in the metrics.
+    """
+    for histogram in metrics.snapshot()['histograms']:
+        if histogram['count'] > 0:
+            labels = ','.join('{}={}'.format(name, value) for name, value in histogram['labels'].items())
+            print('  {:<50} {:6d} x, mean {:8.3f} ms'.format('{}{{{}}}'.format(histogram['name'], labels),
+                                                             histogram['count'],
+                                                             histogram['sum'] / histogram['count'] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=5000, help='the number of message events to replay')
+    parser.add_argument('--channels', type=int, default=200, help='the number of distinct channels')
+    parser.add_argument('--cycles', type=int, default=5, help='the number of menu update cycles')
+    parser.add_argument('--repeat', type=int, default=20, help='the number of parse_pdf repetitions')
+    parser.add_argument('--slack-latency', type=float, default=0.0, help='the duration of a Slack API call in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed of the message events')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='trace the peak Python memory usage (slows down the requests)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='komidabench') as directory:
+        site = MenuSite()
+        komida_parser.WeekMenuIndex.base_url = site.start()
+        slack_client = FakeSlackClient(args.slack_latency)
+        plugin = KomidaPlugin(slack_client=slack_client,
+                              plugin_config={'DATABASE': os.path.join(directory, 'menu.db'),
+                                             'ARCHIVE': os.path.join(directory, 'archive')})
+
+        bench_update(site, args.cycles)
+        bench_parse(site, directory, args.repeat)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        bench_requests(plugin, slack_client, make_events(args.events, args.channels, args.seed))
+        if args.tracemalloc:
+            print('peak traced memory:          {:8.1f} MB'.format(tracemalloc.get_traced_memory()[1] / 1024 ** 2))
+            tracemalloc.stop()
+
+        # ru_maxrss is reported in kilobytes on Linux, for the children only once they have terminated
+        komida_parser._parse_workers.stop()
+        print('peak RSS:                    {:8.1f} MB'.format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        print('peak RSS (parse workers):    {:8.1f} MB'.format(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+        print('stages:')
+        print_stages()
+
+        site.stop()
+
+
+if __name__ == '__main__':
+    main()
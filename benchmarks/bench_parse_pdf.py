@@ -0,0 +1,63 @@
+"""
+Compare the bounding box lookups in `parse_pdf` using pdfquery selectors against the `TextLineIndex`.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_parse_pdf [menu.pdf] [--repeat 20]
+
+A generated sample menu PDF is used if no menu PDF is given.
+"""
+import argparse
+import io
+import time
+
+import pdfquery
+
+from benchmarks.menu_site import get_week_end, make_menu_pdf
+from plugins.komida_layout import TextLineIndex
+from plugins.komida_parser import MENU_BBOX
+
+
+# the bounding boxes that are looked up by `parse_pdf`
+BBOXES = [MENU_BBOX['date']] + [bbox for bboxes in MENU_BBOX['menu_items'].values() for bbox in bboxes]
+
+
+def lookup_selector(pdf):
+    return [pdf.pq('LTTextLineHorizontal:in_bbox("{},{},{},{}")'.format(*bbox)).text() for bbox in BBOXES]
+
+
+def lookup_index(pdf):
+    lines = TextLineIndex.from_pdf(pdf)
+    return [lines.text(bbox) for bbox in BBOXES]
+
+
+def benchmark(func, pdf, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(pdf)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings), sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pdf', nargs='?', help='the menu PDF to parse (default: a generated sample menu)')
+    parser.add_argument('--repeat', type=int, default=20, help='the number of repetitions')
+    args = parser.parse_args()
+
+    pdf = pdfquery.PDFQuery(args.pdf if args.pdf is not None else io.BytesIO(make_menu_pdf(get_week_end())))
+    pdf.load(0)
+
+    print('{} bounding boxes, {} elements on the page'.format(len(BBOXES), len(pdf.tree.xpath('//*'))))
+    result_selector, min_selector, mean_selector = benchmark(lookup_selector, pdf, args.repeat)
+    result_index, min_index, mean_index = benchmark(lookup_index, pdf, args.repeat)
+    print('pdfquery selectors: min {:8.2f} ms, mean {:8.2f} ms'.format(min_selector * 1000, mean_selector * 1000))
+    print('text line index:    min {:8.2f} ms, mean {:8.2f} ms'.format(min_index * 1000, mean_index * 1000))
+    print('speedup: {:.1f}x'.format(mean_selector / mean_index))
+    if result_selector != result_index:
+        raise SystemExit('The text line index results differ from the pdfquery selector results')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Measure the bot's import time and the time to parse the first menu week header.
+
+Each measurement runs in a fresh interpreter to include the cost of importing the required modules.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_startup [--repeat 5]
+"""
+import argparse
+import subprocess
+import sys
+
+
+# code snippets that print their own duration in seconds
+SNIPPETS = [('import rtmbot.core (baseline)',
+             'import rtmbot.core'),
+            ('import plugins.komida_bot',
+             'import plugins.komida_bot'),
+            ('import plugins.komida_parser',
+             'import plugins.komida_parser'),
+            ('first parse_week_end',
+             'from plugins.komida_parser import parse_week_end\n'
+             'parse_week_end("Weekmenu van 6 tot 10 maart")'),
+            ('first dateparser.parse',
+             'import dateparser\n'
+             'dateparser.parse("10 maart", languages=["nl"])')]
+
+TEMPLATE = '''
+import time
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+'''
+
+
+def measure(code, repeat):
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', TEMPLATE.format(code)], universal_newlines=True)
+        timings.append(float(output.strip().splitlines()[-1]))
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='the number of repetitions')
+    args = parser.parse_args()
+
+    for name, code in SNIPPETS:
+        min_time, mean_time = measure(code, args.repeat)
+        print('{:<30} min {:8.1f} ms, mean {:8.1f} ms'.format(name, min_time * 1000, mean_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
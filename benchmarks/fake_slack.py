@@ -0,0 +1,56 @@
+"""
+A stand-in for the `SlackClient` that records all API calls instead of sending them to Slack.
+"""
+import threading
+import time
+
+
+class FakeSlackClient:
+
+    def __init__(self, latency=0.0):
+        """
+        Initialize the fake Slack client.
+
+        Args:
+            latency: The number of seconds each API call takes.
+        """
+        self.latency = latency
+        self.calls = []
+
+        self._lock = threading.Lock()
+
+    def api_call(self, method, **kwargs):
+        """
+        Record an API call.
+
+        Args:
+            method: The Slack API method, such as `chat.postMessage`.
+            kwargs: The arguments of the API call.
+
+        Returns:
+            A successful Slack API response.
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls.append((time.perf_counter(), method, kwargs))
+            return {'ok': True, 'ts': '{:.6f}'.format(time.time())}
+
+    def wait_idle(self, idle=1.0, timeout=300):
+        """
+        Wait until no API calls were made for `idle` seconds.
+
+        Args:
+            idle: The number of seconds without API calls.
+            timeout: The maximum number of seconds to wait.
+
+        Returns:
+            The number of recorded API calls.
+        """
+        deadline = time.perf_counter() + timeout
+        count = -1
+        while count != len(self.calls) and time.perf_counter() < deadline:
+            count = len(self.calls)
+            time.sleep(idle)
+
+        return len(self.calls)
@@ -0,0 +1,208 @@
+"""
+A local stand-in for the komida website that serves a 'Weekmenu' page and generated menu PDFs for all campuses.
+
+The menu PDFs are laid out according to `MENU_BBOX` so that they are parsed like the real menus. Both the page and
+the PDFs support conditional requests using their `ETag`.
+"""
+import datetime
+import hashlib
+import http.server
+import random
+import socketserver
+import threading
+
+from plugins.komida_parser import MENU_BBOX, WeekMenuIndex
+
+
+MONTHS = ['januari', 'februari', 'maart', 'april', 'mei', 'juni', 'juli', 'augustus', 'september', 'oktober',
+          'november', 'december']
+
+DISHES = {'soup': ['Tomatensoep', 'Kervelsoep', 'Pompoensoep', 'Crème van champignons', 'Erwtensoep'],
+          'vegetarian': ['Groentelasagne', 'Quiche met prei', 'Falafel met couscous', 'Veggieburger met frietjes',
+                         'Risotto met paddenstoelen'],
+          'meat': ['Vol-au-vent met frietjes', 'Stoofvlees met frietjes', 'Balletjes in tomatensaus',
+                   'Kipfilet met curry', 'Vispannetje met puree'],
+          'grill': ['Grillburger', 'Kipsaté', 'Spareribs'],
+          'pasta': ['Lasagne of Penne pesto', 'Spaghetti of Tagliatelle']}
+
+
+def get_week_end(today=None):
+    """
+    Get the Friday of the current week.
+
+    Args:
+        today: The current date. Defaults to today.
+
+    Returns:
+        A `datetime` object of the Friday of the week.
+    """
+    if today is None:
+        today = datetime.datetime.today()
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    return today + datetime.timedelta(days=4 - today.weekday())
+
+
+def make_pdf(lines):
+    """
+    Create a single page PDF with the given text lines.
+
+    Args:
+        lines: An iterable of (x, y, text) tuples with the position of the bottom left corner of each line.
+
+    Returns:
+        The content of the PDF.
+    """
+    text = []
+    for x, y, line in lines:
+        line = line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        text.append('BT /F1 9 Tf {} {} Td ({}) Tj ET'.format(x, y, line))
+    stream = '\n'.join(text).encode('latin-1')
+
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+               b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R '
+               b'/Resources << /Font << /F1 5 0 R >> >> >>',
+               b'<< /Length ' + str(len(stream)).encode() + b' >>\nstream\n' + stream + b'\nendstream',
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+    pdf, offsets = bytearray(b'%PDF-1.4\n'), []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += '{} 0 obj\n'.format(i + 1).encode() + obj + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1).encode()
+    for offset in offsets:
+        pdf += '{:010d} 00000 n \n'.format(offset).encode()
+    pdf += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objects) + 1, xref).encode()
+
+    return bytes(pdf)
+
+
+def make_menu_pdf(week_end, seed=0):
+    """
+    Create a menu PDF for the week that ends on the given date.
+
+    Args:
+        week_end: The `datetime` of the Friday of the week.
+        seed: The seed to select the dishes and prices.
+
+    Returns:
+        The content of the menu PDF.
+    """
+    rng = random.Random(seed)
+    week_start = week_end - datetime.timedelta(days=4)
+    lines = [(MENU_BBOX['date'][0] + 5, MENU_BBOX['date'][1] + 10, 'Weekmenu van {} tot {} {}'.format(
+        week_start.day, week_end.day, MONTHS[week_end.month - 1]))]
+    for (_, menu_type), (bb_menu, bb_price) in MENU_BBOX['menu_items'].items():
+        # the grill and pasta bounding boxes overlap, so the grill is placed above the pasta bounding box
+        y = bb_menu[1] + (37 if menu_type == 'grill' else 10)
+        dish = rng.choice(DISHES[menu_type])
+        # the student and staff price of each option
+        prices = []
+        for _ in range(dish.count(' of ') + 1):
+            price = rng.choice([1.5, 3.5, 4.0, 4.5, 5.0])
+            prices.extend([price, price + 1.2])
+        lines.append((bb_menu[0] + 2, y, dish))
+        lines.append((bb_price[0] + 2, y, ' '.join('{:g}'.format(price).replace('.', ',') for price in prices)))
+
+    return make_pdf(lines)
+
+
+class MenuSite:
+
+    def __init__(self, campuses=('cde', 'cgb', 'cmi', 'cst'), week_end=None):
+        """
+        Initialize the local komida website with a menu PDF for each campus.
+
+        Args:
+            campuses: The campuses for which a menu is published.
+            week_end: The `datetime` of the Friday of the published menus. Defaults to the current week.
+        """
+        self.pdfs = {}
+        self.requests = 0
+        for campus in campuses:
+            self.publish(campus, week_end)
+
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        """
+        Get the url of the 'Weekmenu' page.
+        """
+        return 'http://{}:{}/weekmenu/'.format(*self._server.server_address[:2])
+
+    def publish(self, campus, week_end=None, seed=0):
+        """
+        Publish a new menu PDF for the given campus.
+
+        Args:
+            campus: The campus of the menu.
+            week_end: The `datetime` of the Friday of the menu. Defaults to the current week.
+            seed: The seed to select the dishes and prices.
+        """
+        self.pdfs[campus] = make_menu_pdf(week_end or get_week_end(), '{}{}'.format(campus, seed))
+
+    def page(self):
+        """
+        Get the 'Weekmenu' page that links to the menu PDFs of all campuses.
+        """
+        return '<html><body>{}</body></html>'.format(''.join(
+            '<h2>{}</h2><ul><li><a href="/menu/{}.pdf">Weekmenu</a></li></ul>'.format(WeekMenuIndex.campus_id[campus],
+                                                                                       campus)
+            for campus in sorted(self.pdfs))).encode('utf-8')
+
+    def start(self):
+        """
+        Serve the website on a free local port from a background thread.
+
+        Returns:
+            The url of the 'Weekmenu' page.
+        """
+        site = self
+
+        class MenuSiteHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                with site._lock:
+                    site.requests += 1
+                if self.path == '/weekmenu/':
+                    body, content_type = site.page(), 'text/html'
+                elif self.path.startswith('/menu/') and self.path[6:-4] in site.pdfs:
+                    body, content_type = site.pdfs[self.path[6:-4]], 'application/pdf'
+                else:
+                    self.send_error(404)
+                    return
+
+                etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _MenuSiteServer(('127.0.0.1', 0), MenuSiteHandler)
+        threading.Thread(target=self._server.serve_forever, name='MenuSite', daemon=True).start()
+
+        return self.url
+
+    def stop(self):
+        """
+        Stop serving the website.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _MenuSiteServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
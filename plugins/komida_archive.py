@@ -0,0 +1,98 @@
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+
+from .komida_db import database
+
+
+class PdfArchive:
+
+    def __init__(self, root='archive'):
+        """
+        Initialize the content-addressed archive of the retrieved menu PDFs.
+
+        Every PDF is stored once under the hash of its content and indexed by campus and week in the menu database.
+
+        Args:
+            root: The directory in which the PDFs are stored, or None to disable the archive.
+        """
+        self.root = root
+
+    def path(self, content_hash):
+        """
+        Get the file path of an archived PDF.
+
+        Args:
+            content_hash: The hash of the PDF content.
+
+        Returns:
+            The path of the archived PDF.
+        """
+        return os.path.join(self.root, content_hash[:2], '{}.pdf'.format(content_hash))
+
+    def store(self, f_pdf, content_hash, campus, url):
+        """
+        Archive a retrieved menu PDF.
+
+        The PDF is archived before it is parsed, so that PDFs that can't be parsed are archived as well. Its week is
+        indexed as unknown until the menu has been parsed.
+
+        Args:
+            f_pdf: File pointer to the menu PDF.
+            content_hash: The hash of the PDF content.
+            campus: The campus of the menu.
+            url: The url from which the PDF was retrieved.
+        """
+        if self.root is None:
+            return
+
+        path = self.path(content_hash)
+        if not os.path.exists(path):
+            logging.debug('Archive the menu PDF for campus {} as {}'.format(campus.upper(), content_hash))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so that no partial PDFs end up in the archive
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f_archive:
+                f_pdf.seek(0)
+                shutil.copyfileobj(f_pdf, f_archive)
+            os.replace(f_archive.name, path)
+            f_pdf.seek(0)
+
+        database.add_archived_pdf(content_hash, campus, None, url, datetime.datetime.now())
+
+    def index_week(self, content_hash, campus, menu):
+        """
+        Index the week of an archived menu PDF after it has been parsed.
+
+        Args:
+            content_hash: The hash of the PDF content.
+            campus: The campus of the menu.
+            menu: The menu parsed from the PDF, used to determine the menu's week.
+        """
+        # the PDF might not have been archived successfully
+        if self.root is None or not os.path.exists(self.path(content_hash)):
+            return
+
+        database.add_archived_pdf(content_hash, campus, get_week(menu), None, None)
+
+
+def get_week(menu):
+    """
+    Get the week of a parsed menu.
+
+    Args:
+        menu: A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
+
+    Returns:
+        A `datetime` of the Monday of the menu's first week, or None if the menu is empty.
+    """
+    if len(menu) == 0:
+        return None
+
+    first_date = min(date for date, _, _ in menu.keys())
+    return first_date - datetime.timedelta(days=first_date.weekday())
+
+
+# the process-wide menu PDF archive
+archive = PdfArchive()
@@ -4,14 +4,33 @@ import itertools
 import logging
 import random
 import re
-import sqlite3
 
 from rtmbot.core import Plugin
 
-from .komida_parser import KomidaUpdate
+from .komida_archive import archive
+from .komida_cache import attachment_cache, menu_cache
+from .komida_db import database
+from .komida_metrics import metrics
+from .komida_push import KomidaPush
+from .komida_slack import SlackSender
+from .komida_update import CAMPUSES, KomidaUpdate
 
 
-def get_campus(text):
+# subscription commands, optionally followed by the campuses and time, but not questions about subscribing
+_subscription_regex = re.compile(r'^(?:@?komidabot[,:]?\s+)?(?P<intent>un)?subscribe\b[^?]*$')
+
+# dish search requests, optionally followed by a campus and date or week specification
+_search_regex = re.compile(r'\b(?:when is there|when do they have|when do they serve|where is there|which campus has|'
+                           r'search for|search)\s+(?P<dish>.+?)(?P<filters>(?:\s+(?:at|in|on|for)?\s*(?:the\s+)?'
+                           r'(?:campus\s+)?(?:cde|cgb|cmi|cst|drie eiken|groenenborger|middelheim|stad|city|this week|'
+                           r'next week|last week|today|tomorrow|yesterday|monday|tuesday|wednesday|thursday|friday|'
+                           r'saturday|sunday)(?:\s+campus)?)*)\s*[?!.]*$')
+
+# words around the searched dish that are not part of it
+_search_filler_regex = re.compile(r'^(?:(?:a|an|any|some|the|at|in|on|for)\s+)+|(?:\s+(?:at|in|on|for|the))+$')
+
+
+def get_campus(text, default=('cmi',)):
     """
     Check which campus is mentioned in the given text.
 
@@ -19,6 +38,7 @@ def get_campus(text):
 
     Args:
         text: The text in which the occurrence of the campuses is checked.
+        default: The campuses if no campus is explicitly mentioned.
 
     Returns:
         A list with acronyms for all UAntwerp campuses that were mentioned in the text. Defaults to CMI if no campus is
@@ -28,7 +48,7 @@ def get_campus(text):
                       ('cmi', ['cmi', 'middelheim']), ('cst', ['cst', 'stad', 'city'])]
 
     campus = sorted([c_code for c_code, c_texts in campus_options if any(c_text in text for c_text in c_texts)])
-    return campus if len(campus) > 0 else ['cmi']
+    return campus if len(campus) > 0 else list(default)
 
 
 def get_date(text):
@@ -54,6 +74,62 @@ def get_date(text):
     return dates if len(dates) > 0 else [today]
 
 
+def get_search(text):
+    """
+    Check whether the given text is a dish search request.
+
+    A dish can be searched by 'when is there', 'which campus has', 'search', etc. followed by the dish. The campus and
+    'this week', 'next week', 'last week', or the dates as understood by `get_date` can optionally be mentioned before
+    the search request or after the dish.
+
+    Args:
+        text: The text in which the search request is checked.
+
+    Returns:
+        A tuple of the searched dish, the campuses, and the `datetime` objects of the first and last date to search, or
+        None if the text is not a dish search request. Defaults to all campuses and all upcoming dates if no campus,
+        date, or week is explicitly mentioned.
+    """
+    match = _search_regex.search(text)
+    if match is None:
+        return None
+
+    dish = _search_filler_regex.sub('', match.group('dish'))
+    # everything except the dish can specify the campuses and dates
+    filters = text[:match.start('dish')] + ' ' + match.group('filters')
+    campuses = get_campus(filters, default=('cde', 'cgb', 'cmi', 'cst'))
+
+    today = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    monday = today - datetime.timedelta(days=today.weekday())
+    for week, week_diff in [('last week', -1), ('this week', 0), ('next week', 1)]:
+        if week in filters:
+            start = monday + datetime.timedelta(weeks=week_diff)
+            return dish, campuses, start, start + datetime.timedelta(days=6)
+
+    if re.search(r'today|tomorrow|yesterday|monday|tuesday|wednesday|thursday|friday|saturday|sunday', filters):
+        dates = get_date(filters)
+        return dish, campuses, dates[0], dates[-1]
+
+    return dish, campuses, today, datetime.datetime.max
+
+
+def get_time(text, default='11:30'):
+    """
+    Check which time is mentioned in the given text.
+
+    A time can be specified as 'HH:MM', 'HHhMM', or 'HH.MM'.
+
+    Args:
+        text: The text in which the occurrence of a time is checked.
+        default: The time if no time is explicitly mentioned.
+
+    Returns:
+        The first mentioned time as 'HH:MM'. Defaults to 11:30 if no time is explicitly mentioned.
+    """
+    match = re.search(r'\b([01]?\d|2[0-3])[:h.]([0-5]\d)\b', text)
+    return '{:02d}:{}'.format(int(match.group(1)), match.group(2)) if match is not None else default
+
+
 def get_menu(campuses, dates):
     """
     Retrieve the menu on the given dates for the given campuses from the database.
@@ -67,38 +143,100 @@ def get_menu(campuses, dates):
         dictionary with as key the type of menu item and as values the menu content and the prices for students and
         staff.
     """
-    conn = sqlite3.connect('menu.db')
-    c = conn.cursor()
+    keys = list(itertools.product(dates, campuses))
+    menu_items = {key: menu_cache.get(key) for key in keys}
+
+    # retrieve all menus that are not cached yet from the database in a single query
+    uncached = {key for key in keys if menu_items[key] is None}
+    if len(uncached) > 0:
+        # menus that are modified while they are retrieved are not cached
+        generations = {key: menu_cache.generation(key) for key in uncached}
+        for key in uncached:
+            menu_items[key] = {}
+        with metrics.timed('komidabot_stage_seconds', stage='get_menu'):
+            rows = database.get_menu({campus for _, campus in uncached}, {date for date, _ in uncached})
+        for date, campus, menu_type, menu_item, price_student, price_staff in rows:
+            if (date, campus) in uncached:
+                menu_items[(date, campus)][menu_type] = (menu_item, price_student, price_staff)
+        # also cache empty results to avoid repeated lookups for missing menus
+        for key in uncached:
+            menu_cache.put(key, menu_items[key], generations[key])
 
     menu = collections.defaultdict(dict)
-    for date, campus in itertools.product(dates, campuses):
-        c.execute('SELECT type, item, price_student, price_staff FROM menu WHERE date = ? AND campus = ?', (date, campus))
-        for menu_type, menu_item, price_student, price_staff in c.fetchall():
-            menu[(date, campus)][menu_type] = (menu_item, price_student, price_staff)
+    for key in keys:
+        if len(menu_items[key]) > 0:
+            menu[key] = dict(menu_items[key])
 
     return menu
 
 
-def create_attachments(menu):
+def get_attachments(campuses, dates):
     """
-    Format the given menu as a Slack attachment.
+    Retrieve the menu on the given dates for the given campuses formatted as Slack attachments.
+
+    The attachments are rendered only once and are cached until the menu is modified.
 
     Args:
-        menu: A nested dictionary with as keys the dates and campuses and as values a menu items dictionary.
+        campuses: The campuses for which the menu is retrieved.
+        dates: The dates for which the menu is retrieved.
 
     Returns:
-        A list of individual menus as a dictionary formatted to be used as a Slack attachment.
+        A list of the available menus as a dictionary formatted to be used as a Slack attachment.
     """
-    campus_colors = {'cde': 'good', 'cgb': 'warning', 'cmi': 'danger', 'cst': '#439FE0'}
+    keys = list(itertools.product(dates, campuses))
+    attachments = {key: attachment_cache.get(key) for key in keys}
+
+    uncached = [key for key in keys if attachments[key] is None]
+    if len(uncached) > 0:
+        attachments.update(render_attachments(uncached))
+
+    return [attachments[key] for key in keys if len(attachments[key]) > 0]
+
+
+def render_attachments(keys):
+    """
+    Render the menus for the given dates and campuses as Slack attachments and cache them.
+
+    Args:
+        keys: An iterable of (date, campus) tuples.
+
+    Returns:
+        A dictionary with as keys the given dates and campuses and as values the menu formatted as a Slack attachment,
+        or an empty dictionary if no menu is available.
+    """
+    keys = set(keys)
+    # menus that are modified while they are rendered are not cached
+    generations = {key: attachment_cache.generation(key) for key in keys}
+    menu = get_menu({campus for _, campus in keys}, {date for date, _ in keys})
 
-    attachments = []
-    for (date, campus), menu_items in menu.items():
-        attachments.append({'title': 'Menu komida {} on {}'.format(campus.upper(), date.strftime('%A %d %B')),
-                            'color': campus_colors[campus], 'text': format_menu(menu_items)})
+    attachments = {}
+    for date, campus in keys:
+        attachments[(date, campus)] = create_attachment(date, campus, menu[(date, campus)])\
+            if (date, campus) in menu else {}
+        attachment_cache.put((date, campus), attachments[(date, campus)], generations[(date, campus)])
 
     return attachments
 
 
+def create_attachment(date, campus, menu_items):
+    """
+    Format the menu for a single date and campus as a Slack attachment.
+
+    Args:
+        date: The date of the menu.
+        campus: The campus of the menu.
+        menu_items: A dictionary with as key the type of menu item and as values the menu content and the prices for
+                    students and staff.
+
+    Returns:
+        The menu as a dictionary formatted to be used as a Slack attachment.
+    """
+    campus_colors = {'cde': 'good', 'cgb': 'warning', 'cmi': 'danger', 'cst': '#439FE0'}
+
+    return {'title': 'Menu komida {} on {}'.format(campus.upper(), date.strftime('%A %d %B')),
+            'color': campus_colors[campus], 'text': format_menu(menu_items)}
+
+
 def format_menu(menu):
     """
     Textually format a menu.
@@ -117,29 +255,85 @@ def format_menu(menu):
         message.append(':tomato: {} (€{:.2f} / €{:.2f})'.format(*menu['vegetarian']))
     if 'meat' in menu:
         message.append(':poultry_leg: {} (€{:.2f} / €{:.2f})'.format(*menu['meat']))
-    for key in menu.keys():
+    grill, pasta = [], []
+    for key, menu_item in menu.items():
         if 'grill' in key:
-            message.append(':meat_on_bone: {} (€{:.2f} / €{:.2f})'.format(*menu[key]))
-    for key in menu.keys():
-        if 'pasta' in key:
-            message.append(':spaghetti: {} (€{:.2f} / €{:.2f})'.format(*menu[key]))
+            grill.append(':meat_on_bone: {} (€{:.2f} / €{:.2f})'.format(*menu_item))
+        elif 'pasta' in key:
+            pasta.append(':spaghetti: {} (€{:.2f} / €{:.2f})'.format(*menu_item))
+    message.extend(grill)
+    message.extend(pasta)
+
+    return '\n'.join(message)
+
+
+def format_search(dish, menu_items):
+    """
+    Textually format the results of a dish search.
+
+    Args:
+        dish: The searched dish.
+        menu_items: A list of (date, campus, menu_type, menu_item) tuples ordered by date.
+
+    Returns:
+        The dates and campuses on which the dish is on the menu.
+    """
+    if len(menu_items) == 0:
+        return "I'm sorry, I couldn't find {} on the menu.".format(dish)
+
+    message = ['I found {} on the menu:'.format(dish)]
+    for date, campus, _, menu_item in menu_items:
+        message.append('• {} at {}: {}'.format(date.strftime('%A %d %B'), campus.upper(), menu_item))
 
     return '\n'.join(message)
 
 
+def _menu_modified(keys):
+    """
+    Render the modified menus again after they have been stored.
+
+    Args:
+        keys: The set of (date, campus) tuples whose menu was modified.
+    """
+    attachment_cache.invalidate(keys)
+    render_attachments(keys)
+
+
+# keep the rendered menus in sync with the stored menus
+menu_cache.add_listener(_menu_modified)
+
+
 class KomidaPlugin(Plugin):
 
     def __init__(self, name=None, slack_client=None, plugin_config=None):
         """
         Initialize the KomidaBot Slack plugin.
 
-        Includes a timed job to update the menu every hour.
+        Includes a job to update the menu, which runs frequently while the upcoming menus are missing.
         """
         super().__init__(name, slack_client, plugin_config)
 
-        # schedule an update of the menu every two hours
-        self.update = KomidaUpdate(7200)
+        # connect to the menu database
+        database.open(self.plugin_config.get('DATABASE', 'menu.db'))
+        # archive the retrieved menu PDFs
+        archive.root = self.plugin_config.get('ARCHIVE', 'archive')
+
+        # expose the metrics locally and optionally dump them periodically
+        if 'METRICS_PORT' in self.plugin_config:
+            metrics.serve(int(self.plugin_config['METRICS_PORT']))
+        if 'METRICS_JSON' in self.plugin_config:
+            metrics.dump_periodically(self.plugin_config['METRICS_JSON'],
+                                      int(self.plugin_config.get('METRICS_JSON_INTERVAL', 60)))
+
+        # post all messages through a throttled background queue
+        self.sender = SlackSender(slack_client, username='komidabot', icon_emoji=':fork_and_knife:')
+
+        # schedule adaptive updates of the menu
+        self.update = KomidaUpdate()
         self.jobs.append(self.update)
+        # post the menu to the subscribed channels
+        self.push = KomidaPush(self.sender, get_attachments, self.update)
+        self.jobs.append(self.push)
 
     def process_message(self, data):
         """
@@ -150,7 +344,12 @@ class KomidaPlugin(Plugin):
         - Matching the '^l+u+n+c+h+!+$' regex to retrieve the default menu (today at campus Middelheim).
         Or by messaging the komidabot directly.
 
-        A Slack response with the menu or a notification that the requested menu could not be found is sent.
+        A dish can be searched similarly by asking for example 'komidabot when is there lasagne' or 'komidabot which
+        campus has vol-au-vent this week'. Channels can subscribe to the daily menu by 'komidabot subscribe cmi cde
+        11:30' and unsubscribe by 'komidabot unsubscribe'.
+
+        A Slack response with the menu or a notification that the requested menu could not be found is sent. If the menu
+        is not available yet, a menu update is started in the background and the response is sent once it has finished.
 
         Args:
             data: The Slack message.
@@ -168,35 +367,123 @@ class KomidaPlugin(Plugin):
                 ('komidabot' in text or re.search('^l+u+n+c+h+!+$', text) is not None):
             return
 
+        # manage the subscriptions, search the menu history for a dish, or reply with the requested menu
+        search = get_search(text)
+        subscription = _subscription_regex.match(text.strip())
+        if subscription is not None:
+            intent = 'unsubscribe' if subscription.group('intent') is not None else 'subscribe'
+        else:
+            intent = 'search' if search is not None else 'menu'
+        metrics.inc('komidabot_requests_total', intent=intent)
+        with metrics.timed('komidabot_reply_seconds', intent=intent):
+            if intent == 'subscribe':
+                self.subscribe(data['channel'], text)
+            elif intent == 'unsubscribe':
+                self.unsubscribe(data['channel'], text)
+            elif intent == 'search':
+                self.send_search(data['channel'], *search)
+            else:
+                self.reply_menu(data['channel'], text)
+
+    def subscribe(self, channel, text):
+        """
+        Subscribe the channel to the daily menu of the campus(es) and at the time in the request.
+
+        Campuses whose menu isn't retrieved are skipped, and times at or after the push deadline are rejected.
+
+        Args:
+            channel: The channel to which the menu is posted.
+            text: The lowercase text of the subscription request.
+        """
+        requested = get_campus(text)
+        time = get_time(text)
+        # only the menus that are retrieved can be posted, and only before the push deadline
+        campuses = [campus for campus in requested if campus in CAMPUSES]
+        unsupported = [campus for campus in requested if campus not in CAMPUSES]
+        if time >= self.push.until:
+            reply = "I can only post the menu before {}.".format(self.push.until)
+        elif len(campuses) == 0:
+            reply = "I can't post the menu for {}, try {}.".format(', '.join(unsupported).upper(),
+                                                                  ', '.join(CAMPUSES).upper())
+        else:
+            database.add_subscription(channel, campuses, time)
+            logging.info('Channel {} subscribed to the menu for campus {} at {}'.format(
+                channel, ', '.join(campuses).upper(), time))
+            reply = "I'll post the menu for {} here every weekday at {}.".format(', '.join(campuses).upper(), time)
+            if len(unsupported) > 0:
+                reply += " I can't post the menu for {}.".format(', '.join(unsupported).upper())
+
+        self.sender.send(channel, reply, on_error=lambda reason: self.process_error(channel, reason))
+
+    def unsubscribe(self, channel, text):
+        """
+        Unsubscribe the channel from the daily menu of the campus(es) in the request, or from all menus if no campus is
+        mentioned.
+
+        Args:
+            channel: The subscribed channel.
+            text: The lowercase text of the unsubscription request.
+        """
+        campuses = get_campus(text, default=())
+        if database.remove_subscription(channel, campuses if len(campuses) > 0 else None) > 0:
+            logging.info('Channel {} unsubscribed from the menu'.format(channel))
+            reply = "I won't post the menu{} here anymore.".format(
+                ' for {}'.format(', '.join(campuses).upper()) if len(campuses) > 0 else '')
+        else:
+            reply = "This channel isn't subscribed to the menu."
+
+        self.sender.send(channel, reply, on_error=lambda reason: self.process_error(channel, reason))
+
+    def reply_menu(self, channel, text):
+        """
+        Reply to a menu request.
+
+        Args:
+            channel: The channel to which to send the menu.
+            text: The lowercase text of the menu request.
+        """
         # parse the campus(es) and date(s) from the request
         campuses = get_campus(text)
         dates = get_date(text)
 
         # get the requested menus
-        menus = get_menu(campuses, dates)
-        # force a menu update if nothing could be found initially
-        if len(menus) == 0:
+        attachments = get_attachments(campuses, dates)
+        # force a menu update in the background if nothing could be found initially and reply once it has finished
+        if len(attachments) == 0:
             try:
-                logging.debug('No menu found, updating...')
-
-                response = self.slack_client.api_call('chat.postMessage', channel=data['channel'],
-                                                      text="I don't have the menu for {} on {}. Let me see if I can find it online...".format(
-                                                          ', '.join(campuses).upper(), ', '.join([d.strftime('%A %d %B') for d in dates])),
-                                                      username='komidabot', icon_emoji=':fork_and_knife:')
-                if not response['ok']:
-                    self.process_error(data['channel'], response['error'])
-
-                # force a menu update and try to retrieve the requested menu again
-                self.update.run(self.slack_client)
-                menus = get_menu(campuses, dates)
+                if self.update.refresh(lambda: self.send_menu(channel, campuses, dates), force=True):
+                    logging.debug('No menu found, updating...')
+
+                    self.sender.send(channel,
+                                     "I don't have the menu for {} on {}. Let me see if I can find it online...".format(
+                                         ', '.join(campuses).upper(), ', '.join([d.strftime('%A %d %B') for d in dates])),
+                                     coalesce_key=('update', tuple(campuses), tuple(dates)),
+                                     on_error=lambda reason: self.process_error(channel, reason))
+
+                    return
             except Exception as e:
                 logging.exception('Problem while updating the menu: {}'.format(e))
 
-        # reply with the menu
-        if len(menus) > 0:
-            response = self.slack_client.api_call('chat.postMessage', channel=data['channel'], text='*LUNCH!*',
-                                                  attachments=create_attachments(menus),
-                                                  username='komidabot', icon_emoji=':fork_and_knife:')
+        self.send_menu(channel, campuses, dates, attachments)
+
+    def send_menu(self, channel, campuses, dates, attachments=None):
+        """
+        Reply with the requested menu or a notification that the requested menu could not be found.
+
+        Args:
+            channel: The channel to which to send the menu.
+            campuses: The requested campuses.
+            dates: The requested dates.
+            attachments: The requested menus formatted as Slack attachments if they were already retrieved.
+        """
+        if attachments is None:
+            attachments = get_attachments(campuses, dates)
+
+        # reply with the menu, identical menu replies in quick succession are only sent once
+        if len(attachments) > 0:
+            self.sender.send(channel, '*LUNCH!*', attachments,
+                             coalesce_key=('menu', tuple(attachment['title'] for attachment in attachments)),
+                             on_error=lambda reason: self.process_error(channel, reason))
         # or send a final message that no menu could be found
         else:
             fail_gifs = ['https://giphy.com/gifs/monkey-laptop-baboon-xTiTnJ3BooiDs8dL7W',
@@ -204,19 +491,32 @@ class KomidaPlugin(Plugin):
                          'https://giphy.com/gifs/computer-Zw133sEVc0WXK',
                          'https://giphy.com/gifs/computer-D8kdCAJIoSQ6I',
                          'https://giphy.com/gifs/richard-ayoade-it-crowd-maurice-moss-dbtDDSvWErdf2']
-            response = self.slack_client.api_call('chat.postMessage', channel=data['channel'],
-                                                  text="_COMPUTER SAYS NO._ I'm sorry, no menu has been found.\n{}".format(random.choice(fail_gifs)),
-                                                  username='komidabot', icon_emoji=':fork_and_knife:')
+            self.sender.send(channel, "_COMPUTER SAYS NO._ I'm sorry, no menu has been found.\n{}".format(random.choice(fail_gifs)),
+                             coalesce_key=('no menu', tuple(campuses), tuple(dates)),
+                             on_error=lambda reason: self.process_error(channel, reason))
+
+    def send_search(self, channel, dish, campuses, start, end):
+        """
+        Reply with the dates and campuses on which the searched dish is on the menu.
 
-        # check if the menu was correctly sent
-        if not response['ok']:
-            self.process_error(data['channel'], response['error'])
+        Args:
+            channel: The channel to which to send the search results.
+            dish: The searched dish.
+            campuses: The campuses to search.
+            start: The first date to search.
+            end: The last date to search.
+        """
+        menu_items = database.search_menu(dish, campuses, start, end)
+        self.sender.send(channel, format_search(dish, menu_items),
+                         coalesce_key=('search', dish, tuple(campuses), start, end),
+                         on_error=lambda reason: self.process_error(channel, reason))
 
     def process_error(self, channel, reason):
         """
         Send a Slack message to notify the user of an occurred error.
 
-        If the notification cannot be sent an error is logged.
+        No notification is sent if the error was caused by Slack's rate limits. If the notification cannot be sent an
+        error is logged.
 
         Args:
             channel: To channel to which to send the notification.
@@ -225,11 +525,10 @@ class KomidaPlugin(Plugin):
         # log the error
         logging.error('Failed to post to Slack: {}'.format(reason))
 
-        # try to send an error message upon a failure
-        response = self.slack_client.api_call('chat.postMessage', channel=channel,
-                                              text="I'm sorry, I can't tell you the menu. Error status: {}".format(reason),
-                                              username='komidabot', icon_emoji=':fork_and_knife:')
+        # posting another message would only make things worse when being rate limited
+        if reason == 'ratelimited':
+            return
 
-        # check the error status of this message but don't try to resend
-        if not response['ok']:
-            logging.error('Failed to post to Slack: {}'.format(response['error']))
+        # try to send an error message upon a failure, but don't try to resend if this fails as well
+        self.sender.send(channel, "I'm sorry, I can't tell you the menu. Error status: {}".format(reason),
+                         coalesce_key=('error', reason))
@@ -0,0 +1,144 @@
+import collections
+import threading
+import time
+
+from .komida_metrics import metrics
+
+
+class MenuCache:
+
+    def __init__(self, name, maxsize=256, ttl=3600):
+        """
+        Initialize a process-wide LRU cache for menu data, such as the menus retrieved from the database.
+
+        Entries are keyed by (date, campus) and expire `ttl` seconds after they were stored. Once more than `maxsize`
+        entries are cached the least recently used entry is evicted.
+
+        Args:
+            name: The name of the cache in the metrics.
+            maxsize: The maximum number of (date, campus) entries that are kept.
+            ttl: The number of seconds after which an entry expires.
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+        self._generations = collections.Counter()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieve the cached value for the given key.
+
+        Args:
+            key: A (date, campus) tuple.
+
+        Returns:
+            The cached value (which can be empty if no menu exists for the key), or None if the key is not cached or its
+            entry has expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                metrics.inc('komidabot_cache_requests_total', cache=self.name, result='miss')
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc('komidabot_cache_requests_total', cache=self.name, result='hit')
+            return entry[1]
+
+    def generation(self, key):
+        """
+        Get the generation of the given key, which changes whenever the key is invalidated.
+
+        Args:
+            key: A (date, campus) tuple.
+
+        Returns:
+            The current generation of the key.
+        """
+        with self._lock:
+            return self._generations[key]
+
+    def put(self, key, value, generation=None):
+        """
+        Store the value for the given key.
+
+        A value that was computed before the key was invalidated is stale and is not stored. Therefore, retrieve the
+        key's `generation` before computing the value.
+
+        Args:
+            key: A (date, campus) tuple.
+            value: The value to cache, for example a dictionary with as key the type of menu item and as values the menu
+                   content and the prices for students and staff.
+            generation: The generation of the key when the computation of the value started, or None to always store
+                        the value.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generations[key]:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        """
+        Remove the given keys from the cache.
+
+        Registered listeners are notified of the invalidated keys.
+
+        Args:
+            keys: An iterable of (date, campus) tuples whose menu was modified.
+        """
+        keys = set(keys)
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._generations[key] += 1
+            listeners = list(self._listeners)
+
+        if len(keys) > 0:
+            for listener in listeners:
+                listener(keys)
+
+    def add_listener(self, listener):
+        """
+        Register a function that is called with the set of invalidated keys whenever entries are invalidated.
+
+        Args:
+            listener: A function with a single argument.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Report the cache effectiveness.
+
+        Returns:
+            A dictionary with the number of cache hits, misses, and currently cached entries.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+# the process-wide menu cache shared by the bot and the menu updates
+menu_cache = MenuCache('menu')
+# the process-wide cache of menus rendered as Slack attachments
+attachment_cache = MenuCache('attachment')
@@ -0,0 +1,346 @@
+import contextlib
+import logging
+import re
+import sqlite3
+import threading
+
+
+class MenuDatabase:
+
+    def __init__(self, path='menu.db'):
+        """
+        Initialize the menu database access layer.
+
+        A single connection is shared by the RTM thread and the menu updates. Access to the connection is serialized,
+        while the write-ahead log allows other processes to read the database during an update.
+
+        Args:
+            path: The file path of the SQLite database.
+        """
+        self.path = path
+        self.full_text_search = True
+
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def open(self, path=None):
+        """
+        (Re)open the database, optionally at a different location.
+
+        The database schema is created if needed.
+
+        Args:
+            path: The file path of the SQLite database. Defaults to the current path.
+        """
+        with self._lock:
+            self.close()
+            if path is not None:
+                self.path = path
+            self._connect()
+
+    def close(self):
+        """
+        Close the database connection if it is open.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connect(self):
+        """
+        Get the shared database connection, connecting and initializing the schema first if needed.
+
+        Returns:
+            The `sqlite3.Connection` to the database.
+
+        Raises:
+            `sqlite3.NotSupportedError`: The SQLite library is older than version 3.24.
+        """
+        if self._conn is None:
+            # upserts using `INSERT ... ON CONFLICT ... DO UPDATE` require SQLite 3.24
+            if sqlite3.sqlite_version_info < (3, 24, 0):
+                raise sqlite3.NotSupportedError('The menu database requires SQLite 3.24 or newer, found SQLite {}'
+                                                .format(sqlite3.sqlite_version))
+            logging.debug('Connect to the menu database <{}>'.format(self.path))
+            self._conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            init_schema(self._conn)
+            try:
+                init_search_schema(self._conn)
+                self.full_text_search = True
+            except sqlite3.OperationalError as e:
+                logging.warning('Full-text search of the menu is not available: {}'.format(e))
+                self.full_text_search = False
+
+        return self._conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager to execute statements in a single transaction.
+
+        The transaction is committed if the block finishes successfully and rolled back otherwise.
+
+        Yields:
+            A cursor on the shared connection.
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def query(self, sql, parameters=()):
+        """
+        Execute a read-only query.
+
+        Args:
+            sql: The SQL query.
+            parameters: The query parameters.
+
+        Returns:
+            A list of all resulting rows.
+        """
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    def get_menu(self, campuses, dates):
+        """
+        Retrieve all menu items on the given dates for the given campuses in a single query.
+
+        Args:
+            campuses: The campuses for which the menu is retrieved.
+            dates: The dates for which the menu is retrieved.
+
+        Returns:
+            A list of (date, campus, menu_type, menu_item, price_student, price_staff) rows.
+        """
+        campuses, dates = list(campuses), list(dates)
+        if len(campuses) == 0 or len(dates) == 0:
+            return []
+
+        return self.query('SELECT date, campus, type, item, price_student, price_staff FROM menu '
+                          'WHERE date IN ({}) AND campus IN ({})'.format(', '.join('?' * len(dates)),
+                                                                         ', '.join('?' * len(campuses))),
+                          dates + campuses)
+
+    def search_menu(self, query, campuses, start, end, limit=20):
+        """
+        Search the menu items that contain the given words.
+
+        Args:
+            query: The words to search for. Words are matched as prefixes and all words have to occur in the menu item.
+            campuses: The campuses for which the menu is searched.
+            start: The `datetime` of the first date to search.
+            end: The `datetime` of the last date to search.
+            limit: The maximum number of results.
+
+        Returns:
+            A list of (date, campus, menu_type, menu_item) rows ordered by date.
+        """
+        words = re.findall(r'\w+', query)
+        campuses = list(campuses)
+        if len(words) == 0 or len(campuses) == 0:
+            return []
+
+        if self.full_text_search:
+            return self.query('SELECT menu.date, menu.campus, menu.type, menu.item FROM menu_fts '
+                              'JOIN menu ON menu.rowid = menu_fts.rowid WHERE menu_fts MATCH ? AND '
+                              'menu.date BETWEEN ? AND ? AND menu.campus IN ({}) '
+                              'ORDER BY menu.date, menu.campus LIMIT ?'.format(', '.join('?' * len(campuses))),
+                              [' '.join('"{}"*'.format(word) for word in words), start, end] + campuses + [limit])
+        else:
+            return self.query('SELECT date, campus, type, item FROM menu WHERE {} AND date BETWEEN ? AND ? AND '
+                              'campus IN ({}) ORDER BY date, campus LIMIT ?'.format(
+                                  ' AND '.join(['item LIKE ?'] * len(words)), ', '.join('?' * len(campuses))),
+                              ['%{}%'.format(word) for word in words] + [start, end] + campuses + [limit])
+
+    def get_fetch_state(self, url):
+        """
+        Retrieve the state of the previous successful fetch of the given url.
+
+        Args:
+            url: The url that was fetched.
+
+        Returns:
+            A dictionary with the `etag`, `last_modified`, and `content_hash` of the previous fetch, which are None if
+            the url has not been fetched before.
+        """
+        rows = self.query('SELECT etag, last_modified, content_hash FROM fetch_state WHERE url = ?', (url,))
+        etag, last_modified, content_hash = rows[0] if len(rows) > 0 else (None, None, None)
+        return {'etag': etag, 'last_modified': last_modified, 'content_hash': content_hash}
+
+    def set_fetch_state(self, url, etag, last_modified, content_hash):
+        """
+        Store the state of a successful fetch of the given url.
+
+        Args:
+            url: The url that was fetched.
+            etag: The `ETag` header of the response.
+            last_modified: The `Last-Modified` header of the response.
+            content_hash: The hash of the response content.
+        """
+        with self.transaction() as c:
+            c.execute('INSERT OR REPLACE INTO fetch_state VALUES (?, ?, ?, ?)', (url, etag, last_modified, content_hash))
+
+    def add_archived_pdf(self, content_hash, campus, week, url, retrieved):
+        """
+        Index an archived menu PDF.
+
+        Args:
+            content_hash: The hash of the PDF content, which identifies the archived file.
+            campus: The campus of the menu.
+            week: The Monday of the menu's week, or None if it is unknown.
+            url: The url from which the PDF was retrieved.
+            retrieved: The `datetime` at which the PDF was retrieved.
+        """
+        with self.transaction() as c:
+            c.execute('INSERT INTO pdf_archive VALUES (?, ?, ?, ?, ?) ON CONFLICT(content_hash, campus) DO UPDATE SET '
+                      'week = COALESCE(excluded.week, week)', (content_hash, campus, week, url, retrieved))
+
+    def get_archived_pdfs(self, campuses, start, end):
+        """
+        Retrieve the archived menu PDFs for the given campuses and weeks.
+
+        PDFs whose week is unknown are selected based on the date at which they were retrieved.
+
+        Args:
+            campuses: The campuses for which the PDFs are retrieved.
+            start: The `datetime` of the first week.
+            end: The `datetime` of the last week.
+
+        Returns:
+            A list of (content_hash, campus, week, retrieved) rows ordered by the date at which the PDFs were retrieved.
+        """
+        campuses = list(campuses)
+        return self.query('SELECT content_hash, campus, week, retrieved FROM pdf_archive WHERE campus IN ({}) AND '
+                          'COALESCE(week, retrieved) BETWEEN ? AND ? ORDER BY retrieved, content_hash'.format(
+                              ', '.join('?' * len(campuses))), campuses + [start, end])
+
+    def add_subscription(self, channel, campuses, time):
+        """
+        Subscribe a channel to the daily menu of the given campuses.
+
+        Existing subscriptions of the channel to these campuses are updated to the new time.
+
+        Args:
+            channel: The channel to which the menu is posted.
+            campuses: The campuses for which the menu is posted.
+            time: The time at which the menu is posted as 'HH:MM'.
+        """
+        with self.transaction() as c:
+            c.executemany('INSERT INTO subscriptions VALUES (?, ?, ?, NULL) ON CONFLICT(channel, campus) DO UPDATE SET '
+                          'time = excluded.time', [(channel, campus, time) for campus in campuses])
+
+    def remove_subscription(self, channel, campuses=None):
+        """
+        Unsubscribe a channel from the daily menu.
+
+        Args:
+            channel: The subscribed channel.
+            campuses: The campuses to unsubscribe from. Defaults to all campuses.
+
+        Returns:
+            The number of removed subscriptions.
+        """
+        with self.transaction() as c:
+            if campuses is None:
+                c.execute('DELETE FROM subscriptions WHERE channel = ?', (channel,))
+            else:
+                campuses = list(campuses)
+                c.execute('DELETE FROM subscriptions WHERE channel = ? AND campus IN ({})'.format(
+                    ', '.join('?' * len(campuses))), [channel] + campuses)
+            return c.rowcount
+
+    def get_subscriptions(self, channel=None):
+        """
+        Retrieve the menu subscriptions.
+
+        Args:
+            channel: The channel for which the subscriptions are retrieved. Defaults to all channels.
+
+        Returns:
+            A list of (channel, campus, time, last_sent) rows, with `last_sent` the date on which the menu was last
+            posted or None.
+        """
+        if channel is None:
+            return self.query('SELECT channel, campus, time, last_sent FROM subscriptions ORDER BY channel, campus')
+        else:
+            return self.query('SELECT channel, campus, time, last_sent FROM subscriptions WHERE channel = ? '
+                              'ORDER BY campus', (channel,))
+
+    def set_subscriptions_sent(self, subscriptions, date):
+        """
+        Record that the menu was posted for the given subscriptions.
+
+        Args:
+            subscriptions: An iterable of (channel, campus) tuples.
+            date: The `datetime` of the menu that was posted.
+        """
+        with self.transaction() as c:
+            c.executemany('UPDATE subscriptions SET last_sent = ? WHERE channel = ? AND campus = ?',
+                          [(date, channel, campus) for channel, campus in subscriptions])
+
+
+def init_schema(conn):
+    """
+    Initialize the menu items database.
+
+    The database contains a `menu` table of the form `(date, campus, menu_type, menu_item, price_student, price_staff)`.
+    The primary key on `(date, campus, menu_type)` doubles as the index to look up menus by date and campus.
+    Additionally, the `fetch_state` table of the form `(url, etag, last_modified, content_hash)` keeps track of the
+    previously downloaded menus, the `pdf_archive` table of the form `(content_hash, campus, week, url, retrieved)`
+    indexes the archived menu PDFs, and the `subscriptions` table of the form `(channel, campus, time, last_sent)`
+    contains the channels to which the menu is posted daily.
+
+    Args:
+        conn: The `sqlite3.Connection` in which the schema is created.
+    """
+    conn.execute('CREATE TABLE IF NOT EXISTS menu (date TIMESTAMP, campus TEXT, type TEXT, item TEXT, '
+                 'price_student REAL, price_staff REAL, PRIMARY KEY(date, campus, type))')
+    conn.execute('CREATE TABLE IF NOT EXISTS fetch_state (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                 'content_hash TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS pdf_archive (content_hash TEXT, campus TEXT, week TIMESTAMP, url TEXT, '
+                 'retrieved TIMESTAMP, PRIMARY KEY(content_hash, campus))')
+    conn.execute('CREATE INDEX IF NOT EXISTS pdf_archive_week ON pdf_archive (campus, week)')
+    conn.execute('CREATE TABLE IF NOT EXISTS subscriptions (channel TEXT, campus TEXT, time TEXT, '
+                 'last_sent TIMESTAMP, PRIMARY KEY(channel, campus))')
+    conn.commit()
+
+
+def init_search_schema(conn):
+    """
+    Initialize the full-text index over the menu items.
+
+    The `menu_fts` FTS5 table indexes the `item` column of the `menu` table and is kept in sync with it by triggers, so
+    that every insert, update, and delete by `store_menu` is reflected in the index.
+
+    Args:
+        conn: The `sqlite3.Connection` in which the schema is created.
+
+    Raises:
+        `sqlite3.OperationalError`: SQLite was compiled without FTS5 support.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'menu_fts'").fetchone()
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS menu_fts USING fts5(item, content='menu', content_rowid='rowid', "
+                 "tokenize='unicode61 remove_diacritics 1')")
+    conn.execute('CREATE TRIGGER IF NOT EXISTS menu_fts_insert AFTER INSERT ON menu BEGIN '
+                 'INSERT INTO menu_fts(rowid, item) VALUES (new.rowid, new.item); END')
+    conn.execute('CREATE TRIGGER IF NOT EXISTS menu_fts_delete AFTER DELETE ON menu BEGIN '
+                 "INSERT INTO menu_fts(menu_fts, rowid, item) VALUES ('delete', old.rowid, old.item); END")
+    conn.execute('CREATE TRIGGER IF NOT EXISTS menu_fts_update AFTER UPDATE OF item ON menu BEGIN '
+                 "INSERT INTO menu_fts(menu_fts, rowid, item) VALUES ('delete', old.rowid, old.item); "
+                 'INSERT INTO menu_fts(rowid, item) VALUES (new.rowid, new.item); END')
+    # index the previously stored menus
+    if exists is None:
+        conn.execute("INSERT INTO menu_fts(menu_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+# the process-wide menu database
+database = MenuDatabase()
@@ -0,0 +1,75 @@
+import collections
+
+
+class TextLineIndex:
+
+    def __init__(self, lines, cell_size=50):
+        """
+        Build a spatial index over the text lines of a PDF page.
+
+        The lines are assigned to the cells of a regular grid based on their bottom left corner. A bounding box lookup
+        only has to consider the lines in the grid cells that the bounding box covers instead of all lines on the page.
+
+        Args:
+            lines: An iterable of (x0, y0, x1, y1, text) tuples in document order.
+            cell_size: The width and height of the grid cells.
+        """
+        self.cell_size = cell_size
+
+        self._lines = []
+        self._grid = collections.defaultdict(list)
+        for x0, y0, x1, y1, text in lines:
+            self._grid[(int(x0 // cell_size), int(y0 // cell_size))].append(len(self._lines))
+            self._lines.append((x0, y0, x1, y1, text))
+
+    @classmethod
+    def from_pdf(cls, pdf, **kwargs):
+        """
+        Build a spatial index over the horizontal text lines of a loaded PDF.
+
+        Args:
+            pdf: The `pdfquery.PDFQuery` whose pages are loaded.
+            kwargs: Additional arguments for the `TextLineIndex`.
+
+        Returns:
+            The `TextLineIndex` of the PDF.
+        """
+        return cls(((float(line.get('x0')), float(line.get('y0')), float(line.get('x1')), float(line.get('y1')),
+                     pdf.pq(line).text()) for line in pdf.tree.iter('LTTextLineHorizontal')), **kwargs)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def in_bbox(self, bbox):
+        """
+        Find the text lines that are fully contained within the given bounding box.
+
+        This is equivalent to the pdfquery `LTTextLineHorizontal:in_bbox("x0,y0,x1,y1")` selector.
+
+        Args:
+            bbox: A (x0, y0, x1, y1) tuple.
+
+        Returns:
+            A list of the texts of the contained lines in document order.
+        """
+        x0, y0, x1, y1 = bbox
+        candidates = []
+        for cell_x in range(int(x0 // self.cell_size), int(x1 // self.cell_size) + 1):
+            for cell_y in range(int(y0 // self.cell_size), int(y1 // self.cell_size) + 1):
+                candidates.extend(self._grid.get((cell_x, cell_y), ()))
+
+        lines = (self._lines[i] for i in sorted(candidates))
+        return [text for l_x0, l_y0, l_x1, l_y1, text in lines
+                if l_x0 >= x0 and l_y0 >= y0 and l_x1 <= x1 and l_y1 <= y1]
+
+    def text(self, bbox):
+        """
+        Get the text within the given bounding box.
+
+        Args:
+            bbox: A (x0, y0, x1, y1) tuple.
+
+        Returns:
+            The texts of all lines that are fully contained within the bounding box joined by spaces.
+        """
+        return ' '.join(self.in_bbox(bbox))
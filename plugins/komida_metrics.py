@@ -0,0 +1,225 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metrics:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Initialize a process-wide registry of counters and latency histograms.
+
+        Metrics are identified by their name and optional labels, such as the stage of a menu update or the campus. The
+        metrics can be exposed in the Prometheus text format over HTTP and dumped as JSON.
+
+        Args:
+            buckets: The upper bounds in seconds of the histogram buckets in ascending order.
+        """
+        self.buckets = tuple(buckets)
+
+        self._counters = collections.defaultdict(int)
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self._dump_thread = None
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increment a counter.
+
+        Args:
+            name: The name of the counter.
+            amount: The amount by which the counter is incremented.
+            labels: The labels of the counter.
+        """
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value in a histogram.
+
+        Args:
+            name: The name of the histogram.
+            value: The observed value, typically a duration in seconds.
+            labels: The labels of the histogram.
+        """
+        with self._lock:
+            key = (name, tuple(sorted(labels.items())))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """
+        Record the duration of the enclosed block in a histogram, also if the block raises an exception.
+
+        Args:
+            name: The name of the histogram.
+            labels: The labels of the histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Get the current values of all metrics.
+
+        Returns:
+            A dictionary with a list of all `counters` and all `histograms`. The histogram buckets are cumulative and
+            keyed by their upper bound.
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                cumulative, buckets = 0, collections.OrderedDict()
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets['+Inf'] = histogram['count']
+                histograms.append({'name': name, 'labels': dict(labels), 'buckets': buckets,
+                                   'sum': histogram['sum'], 'count': histogram['count']})
+
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """
+        Format all metrics in the Prometheus text exposition format.
+
+        Returns:
+            The metrics as text.
+        """
+        snapshot = self.snapshot()
+        lines, typed = [], set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                lines.append('# TYPE {} counter'.format(counter['name']))
+                typed.add(counter['name'])
+            lines.append('{}{} {}'.format(counter['name'], _format_labels(counter['labels']), counter['value']))
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}_bucket{} {}'.format(name, _format_labels(histogram['labels'], le=bound), count))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(name, _format_labels(histogram['labels']), histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Expose the metrics in the Prometheus text format on `http://<host>:<port>/metrics` from a background thread.
+
+        Args:
+            port: The port on which the metrics are served.
+            host: The address on which the metrics are served. Defaults to the local host only.
+
+        Returns:
+            The address on which the metrics are served.
+        """
+        if self._server is None:
+            registry = self
+
+            class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.to_prometheus().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    logging.debug('Metrics request: {}'.format(format % args))
+
+            self._server = _MetricsServer((host, port), MetricsHandler)
+            threading.Thread(target=self._server.serve_forever, name='KomidaMetrics', daemon=True).start()
+            logging.info('Serving metrics on http://{}:{}/metrics'.format(*self._server.server_address[:2]))
+
+        return self._server.server_address
+
+    def dump_json(self, path):
+        """
+        Write the current values of all metrics to a JSON file.
+
+        Args:
+            path: The path of the JSON file, which is replaced atomically.
+        """
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self.snapshot(), timestamp=time.time()), f)
+        os.replace(tmp_path, path)
+
+    def dump_periodically(self, path, interval=60):
+        """
+        Write the metrics to a JSON file from a background thread every `interval` seconds.
+
+        Args:
+            path: The path of the JSON file.
+            interval: The number of seconds between dumps.
+        """
+        def dump():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump_json(path)
+                except OSError as e:
+                    logging.error('Could not dump the metrics to {}: {}'.format(path, e))
+
+        if self._dump_thread is None:
+            self._dump_thread = threading.Thread(target=dump, name='KomidaMetricsDump', daemon=True)
+            self._dump_thread.start()
+
+
+class _MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def _format_labels(labels, **extra_labels):
+    """
+    Format metric labels in the Prometheus text format.
+
+    Args:
+        labels: A dictionary of label names and values.
+        extra_labels: Additional labels that are appended.
+
+    Returns:
+        The labels as `{name="value",...}`, or an empty string if there are no labels.
+    """
+    labels = list(labels.items()) + list(extra_labels.items())
+    if len(labels) == 0:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels))
+
+
+# the process-wide metrics registry
+metrics = Metrics()
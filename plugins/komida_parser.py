@@ -1,30 +1,206 @@
+import collections
+import concurrent.futures
 import datetime
+import hashlib
 import itertools
 import logging
-import os
+import mmap
 import re
-import sqlite3
 import tempfile
+import threading
+import time
 import urllib.parse
 
-import dateparser
 import lxml.html
 import pdfquery
 import requests
-from rtmbot.core import Job
+
+from .komida_archive import archive
+from .komida_cache import menu_cache
+from .komida_db import database
+from .komida_layout import TextLineIndex
+from .komida_metrics import metrics
+from .komida_worker import ParseError, ParseWorkerPool
 
 
 # disable low-level pdfminer logging
 logging.getLogger('pdfminer').setLevel(logging.WARNING)
 
+# bounding boxes of the menu date and of the (weekday, menu_type) -> (menu_item, price) on the menu PDF
+MENU_BBOX = {'date': (415, 750, 750, 775),
+             'menu_items': {(0, 'soup'): ((90, 640, 235, 700), (230, 640, 285, 700)),
+                            (0, 'vegetarian'): ((90, 590, 235, 650), (230, 590, 285, 650)),
+                            (0, 'meat'): ((90, 535, 235, 600), (230, 535, 285, 600)),
+                            (2, 'soup'): ((90, 435, 235, 495), (230, 435, 285, 495)),
+                            (2, 'vegetarian'): ((90, 385, 235, 445), (230, 385, 285, 445)),
+                            (2, 'meat'): ((90, 335, 235, 395), (230, 335, 285, 395)),
+                            (4, 'soup'): ((90, 235, 235, 290), (230, 235, 285, 290)),
+                            (4, 'vegetarian'): ((90, 185, 235, 245), (230, 185, 285, 245)),
+                            (4, 'meat'): ((90, 130, 235, 195), (230, 130, 285, 195)),
+                            (1, 'soup'): ((350, 640, 485, 700), (480, 640, 555, 700)),
+                            (1, 'vegetarian'): ((350, 590, 485, 650), (480, 590, 555, 650)),
+                            (1, 'meat'): ((350, 535, 485, 600), (480, 535, 555, 600)),
+                            (3, 'soup'): ((350, 435, 485, 495), (480, 435, 555, 495)),
+                            (3, 'vegetarian'): ((350, 385, 485, 445), (480, 385, 555, 445)),
+                            (3, 'meat'): ((350, 335, 485, 395), (480, 335, 555, 395)),
+                            (None, 'grill'): ((350, 185, 485, 245), (480, 185, 555, 245)),
+                            (None, 'pasta'): ((350, 125, 485, 205), (480, 125, 555, 205))}}
+
+# Dutch month names and abbreviations
+_months = {'januari': 1, 'jan': 1, 'februari': 2, 'feb': 2, 'maart': 3, 'mrt': 3, 'maa': 3, 'april': 4, 'apr': 4,
+           'mei': 5, 'juni': 6, 'jun': 6, 'juli': 7, 'jul': 7, 'augustus': 8, 'aug': 8, 'september': 9, 'sep': 9,
+           'sept': 9, 'oktober': 10, 'okt': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12}
+# the end of the week in the menu header, such as "tot 10 maart" or "t.e.m. 10 maart 2017"
+_week_end_regex = re.compile(r'(?:-|\btot|\bt\.?e\.?m\.?|\bt/m)\s*(\d{1,2})\s+([a-z]+)\.?(?:\s+(\d{4}))?', re.IGNORECASE)
+
+# connect and read timeouts in seconds for all requests to the komida website
+TIMEOUT = (10, 30)
+
+# pooled HTTP session to reuse connections to the komida website
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+# worker pools to retrieve the menus of multiple campuses concurrently
+_download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+_parse_workers = ParseWorkerPool(size=3)
+
+# the most recently retrieved 'Weekmenu' page index
+_weekmenu_index = None
+_weekmenu_index_lock = threading.Lock()
+
+
+def conditional_get(url, etag=None, last_modified=None, stream=False):
+    """
+    Retrieve the given url unless it was not modified since it was previously retrieved.
+
+    Args:
+        url: The url to retrieve.
+        etag: The `ETag` of the previously retrieved response, or None.
+        last_modified: The `Last-Modified` date of the previously retrieved response, or None.
+        stream: Whether to defer downloading the response content.
+
+    Returns:
+        The `requests.Response`, or None if the server reports that the content was not modified.
+
+    Raises:
+        `requests.HTTPError`: The url could not be retrieved.
+    """
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    response = session.get(url, headers=headers, stream=stream, timeout=TIMEOUT)
+    # release the connection back to the pool, streamed responses otherwise keep it until they are closed
+    if response.status_code == requests.codes.not_modified:
+        response.close()
+        return None
+    try:
+        response.raise_for_status()
+    except requests.HTTPError:
+        response.close()
+        raise
+
+    return response
+
+
+class WeekMenuIndex:
+
+    base_url = 'https://www.uantwerpen.be/nl/campusleven/eten/weekmenu/'
+    campus_id = {'cmi': 'Campus Middelheim', 'cde': 'Campus Drie Eiken',
+                 'cgb': 'Campus Groenenborger', 'cst': 'Stadscampus'}
+
+    def __init__(self, content, etag=None, last_modified=None):
+        """
+        Parse the komida 'Weekmenu' page to find the urls to the latest pdf menus for all campuses.
+
+        Args:
+            content: The HTML content of the 'Weekmenu' page.
+            etag: The `ETag` of the 'Weekmenu' page response.
+            last_modified: The `Last-Modified` date of the 'Weekmenu' page response.
+        """
+        self.etag = etag
+        self.last_modified = last_modified
+        self.retrieved = time.monotonic()
+
+        # find the menus for all campuses
+        self.urls = {}
+        page = lxml.html.fromstring(content)
+        for header in page.xpath('//h2'):
+            campus = next((c_code for c_code, c_name in self.campus_id.items()
+                           if c_name in (header.text or '') and c_code not in self.urls), None)
+            url = header.xpath('following::li[1]/a/@href') if campus is not None else None
+            if url:
+                self.urls[campus] = urllib.parse.urljoin(self.base_url, url[0])
+                logging.debug('Retrieved menu url for campus {}: <{}>'.format(campus.upper(), self.urls[campus]))
+
+    def get_menu_url(self, campus):
+        """
+        Get the url to the latest pdf menu for the given campus.
+
+        Args:
+            campus: The campus for which the pdf menu has to be retrieved.
+
+        Returns:
+            The menu url of the specified campus.
+
+        Raises:
+            `LookupError`: The requested menu url could not be found on the 'Weekmenu' page.
+        """
+        try:
+            return self.urls[campus]
+        except KeyError:
+            raise LookupError('Error while parsing the HTML page: no menu found for campus {}'.format(campus.upper()))
+
+
+def get_weekmenu_index(max_age=300):
+    """
+    Get the index of the menu urls on the komida 'Weekmenu' page.
+
+    The index is shared by all menu retrievals within `max_age` seconds. Afterwards the page is requested again, but
+    only downloaded and parsed if it was modified.
 
-def get_menu_url(campus):
+    Args:
+        max_age: The number of seconds during which a previously retrieved index is reused.
+
+    Returns:
+        The `WeekMenuIndex` of the 'Weekmenu' page.
+
+    Raises:
+        `requests.HTTPError`: The 'Weekmenu' page could not be retrieved.
     """
-    Parse the komida 'Weekmenu' page to find the url to the latest pdf menu for komida Middelheim.
+    global _weekmenu_index
+
+    with _weekmenu_index_lock:
+        index = _weekmenu_index
+        if index is not None and time.monotonic() - index.retrieved < max_age:
+            return index
+
+        logging.debug("Load the general 'Weekmenu' page")
+        if index is not None:
+            response = conditional_get(WeekMenuIndex.base_url, index.etag, index.last_modified)
+        else:
+            response = conditional_get(WeekMenuIndex.base_url)
+        if response is None:
+            logging.debug("'Weekmenu' page not modified")
+            index.retrieved = time.monotonic()
+        else:
+            index = WeekMenuIndex(response.content, response.headers.get('ETag'),
+                                  response.headers.get('Last-Modified'))
+            _weekmenu_index = index
+
+        return index
+
+
+def get_menu_url(campus, index=None):
+    """
+    Find the url to the latest pdf menu for the given campus on the komida 'Weekmenu' page.
 
     Args:
         campus: The campus for which the pdf menu has to be retrieved. Can be either `cmi` for Campus Middelheim, `cde`
                 for Campus Drie Eiken, `cgb` for Campus Groenenborger, or `cst` for the City Campus.
+        index: The `WeekMenuIndex` to use. Defaults to the recently retrieved index.
 
     Returns:
         The menu url of the specified campus.
@@ -33,102 +209,151 @@ def get_menu_url(campus):
         `requests.HTTPError`: The 'Weekmenu' page could not be retrieved.
         `LookupError`: The requested menu url could not be found on the 'Weekmenu' page.
     """
-    base_url = 'https://www.uantwerpen.be/nl/campusleven/eten/weekmenu/'
-    campus_id = {'cmi': 'Campus Middelheim', 'cde': 'Campus Drie Eiken',
-                 'cgb': 'Campus Groenenborger', 'cst': 'Stadscampus'}
+    if index is None:
+        index = get_weekmenu_index()
 
-    # find the menu for the specified campus
-    logging.debug("Load the general 'Weekmenu' page")
-    r_komida = requests.get(base_url)
-    r_komida.raise_for_status()
+    return index.get_menu_url(campus)
 
-    try:
-        page = lxml.html.fromstring(r_komida.content)
-        url = page.xpath('//h2[contains(text(), "{}")]/following::li[1]/a/@href'.format(campus_id[campus]))[0]
-        url = urllib.parse.urljoin('https://www.uantwerpen.be/', url)
-        logging.debug('Retrieved menu url for campus {}: <{}>'.format(campus.upper(), url))
 
-        return url
-    except IndexError as e:
-        raise LookupError('Error while parsing the HTML page: {}'.format(e))
-
-
-def download_pdf(url):
+def download_pdf(url, max_size=20 * 1024 * 1024, chunk_size=64 * 1024, deadline=None):
     """
-    Download the given url and save the content to a temporary file.
+    Download the given url and save the content to a temporary file, unless it was not modified since the previous
+    successful download.
+
+    The content is streamed to the temporary file in chunks and hashed while it is downloaded.
 
     Args:
         url: The url to download.
+        max_size: The maximum size of the pdf in bytes.
+        chunk_size: The number of bytes that are read at once.
+        deadline: The `time.monotonic()` time by which the download must be finished, or None for no overall limit.
+                  `TIMEOUT` only limits the individual reads.
 
     Returns:
-        A file pointer to the temporary file where the url's contents were saved.
+        A tuple of the named temporary file where the url's contents were saved and a dictionary with the `etag`,
+        `last_modified`, and `content_hash` of the download, or None if the url was not modified.
 
     Raises:
-        `requests.HTTPError`: The pdf could not be retrieved.
+        `requests.RequestException`: The pdf could not be retrieved, exceeds the maximum size, or could not be
+                                     downloaded before the deadline.
     """
     logging.debug('Download the menu PDF')
-    r_pdf = requests.get(url)
-    r_pdf.raise_for_status()  # check whether the pdf was correctly downloaded
+    fetch_state = database.get_fetch_state(url)
+    r_pdf = conditional_get(url, fetch_state['etag'], fetch_state['last_modified'], stream=True)
+    if r_pdf is None:
+        logging.debug('Menu PDF <{}> not modified'.format(url))
+        return None
 
-    # write the pdf to a temporary file
-    logging.debug('Save the menu PDF to a temporary file')
-    fp = tempfile.TemporaryFile()
-    fp.write(r_pdf.content)
-    fp.seek(0)
+    # `Response` only supports the context manager protocol since requests 2.18
+    try:
+        if int(r_pdf.headers.get('Content-Length', 0)) > max_size:
+            raise requests.RequestException('The menu PDF exceeds the maximum size of {} bytes'.format(max_size))
 
-    return fp
+        # stream the pdf to a temporary file
+        logging.debug('Save the menu PDF to a temporary file')
+        fp = tempfile.NamedTemporaryFile(prefix='komida', suffix='.pdf')
+        try:
+            content_hash, size = hashlib.sha256(), 0
+            for chunk in r_pdf.iter_content(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise requests.RequestException('The menu PDF exceeds the maximum size of {} bytes'.format(max_size))
+                if deadline is not None and time.monotonic() > deadline:
+                    raise requests.RequestException('The menu PDF download did not finish in time')
+                content_hash.update(chunk)
+                fp.write(chunk)
+            fp.flush()
+            fp.seek(0)
+        except BaseException:
+            fp.close()
+            raise
+    finally:
+        r_pdf.close()
+
+    return fp, {'etag': r_pdf.headers.get('ETag'), 'last_modified': r_pdf.headers.get('Last-Modified'),
+                'content_hash': content_hash.hexdigest()}
+
+
+def parse_week_end(week, today=None):
+    """
+    Parse the last day of the week from the week header of a menu PDF.
+
+    The header is expected to be of the form "... tot/t.e.m./t/m/- <day> <month> [<year>]" with a Dutch month name. If
+    the year is missing, the year that results in the date closest to today is used. Headers in a different format are
+    parsed using `dateparser`.
 
+    Args:
+        week: The week header text.
+        today: The current date. Defaults to today.
 
-def parse_pdf(f_pdf, campus):
+    Returns:
+        A `datetime` object of the last day of the week, or None if the header could not be parsed.
+    """
+    match = _week_end_regex.search(week)
+    if match is not None and match.group(2).lower() in _months:
+        day, month, year = int(match.group(1)), _months[match.group(2).lower()], match.group(3)
+        if today is None:
+            today = datetime.datetime.today()
+        try:
+            if year is not None:
+                return datetime.datetime(int(year), month, day)
+            candidates = [datetime.datetime(y, month, day) for y in (today.year - 1, today.year, today.year + 1)]
+            return min(candidates, key=lambda d: abs(d - today))
+        except ValueError:
+            pass
+
+    # fall back to the slow generic date parser
+    date_split_keys = ('-', 'tot', 'tem', 't/m')
+    if any(date_split_key in week for date_split_key in date_split_keys):
+        import dateparser
+        end_date = dateparser.parse(re.split('|'.join(date_split_keys), week)[1], languages=['nl'])
+        # `dateparser` completes a missing year relative to the actual current date
+        if end_date is not None and today is not None and str(end_date.year) not in week:
+            try:
+                candidates = [end_date.replace(year=y) for y in (today.year - 1, today.year, today.year + 1)]
+                end_date = min(candidates, key=lambda d: abs(d - today))
+            except ValueError:
+                pass
+        return end_date
+    else:
+        return None
+
+
+def parse_pdf(f_pdf, campus, today=None):
     """
     Parse the menu items from the menu PDF.
 
     Args:
         f_pdf: File pointer to the menu PDF.
         campus: Campus for which the given PDF contains the menu.
+        today: The date relative to which the menu's week is determined, i.e. the date at which the PDF was retrieved.
+               Defaults to today.
 
     Returns:
         A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
     """
-    bbox = {'date': (415, 750, 750, 775),
-            'menu_items': {(0, 'soup'): ((90, 640, 235, 700), (230, 640, 285, 700)),
-                           (0, 'vegetarian'): ((90, 590, 235, 650), (230, 590, 285, 650)),
-                           (0, 'meat'): ((90, 535, 235, 600), (230, 535, 285, 600)),
-                           (2, 'soup'): ((90, 435, 235, 495), (230, 435, 285, 495)),
-                           (2, 'vegetarian'): ((90, 385, 235, 445), (230, 385, 285, 445)),
-                           (2, 'meat'): ((90, 335, 235, 395), (230, 335, 285, 395)),
-                           (4, 'soup'): ((90, 235, 235, 290), (230, 235, 285, 290)),
-                           (4, 'vegetarian'): ((90, 185, 235, 245), (230, 185, 285, 245)),
-                           (4, 'meat'): ((90, 130, 235, 195), (230, 130, 285, 195)),
-                           (1, 'soup'): ((350, 640, 485, 700), (480, 640, 555, 700)),
-                           (1, 'vegetarian'): ((350, 590, 485, 650), (480, 590, 555, 650)),
-                           (1, 'meat'): ((350, 535, 485, 600), (480, 535, 555, 600)),
-                           (3, 'soup'): ((350, 435, 485, 495), (480, 435, 555, 495)),
-                           (3, 'vegetarian'): ((350, 385, 485, 445), (480, 385, 555, 445)),
-                           (3, 'meat'): ((350, 335, 485, 395), (480, 335, 555, 395)),
-                           (None, 'grill'): ((350, 185, 485, 245), (480, 185, 555, 245)),
-                           (None, 'pasta'): ((350, 125, 485, 205), (480, 125, 555, 205))}}
-
     # load the pdf
     logging.debug('Load the menu PDF')
     pdf = pdfquery.PDFQuery(f_pdf)
     pdf.load(0)
+    # index the text lines once to look up all bounding boxes efficiently
+    lines = TextLineIndex.from_pdf(pdf)
 
     # parse the menu's date
     logging.debug('Parse the menu date')
-    week = pdf.pq('LTTextLineHorizontal:in_bbox("{},{},{},{}")'.format(*bbox['date'])).text()
-    date_split_keys = ('-', 'tot', 'tem', 't/m')
-    end_date = dateparser.parse(re.split('|'.join(date_split_keys), week)[1], languages=['nl'])\
-        if any(date_split_key in week for date_split_key in date_split_keys) else None
+    week = lines.text(MENU_BBOX['date'])
+    if today is None:
+        today = datetime.datetime.today()
+    end_date = parse_week_end(week, today)
     # check whether the date was parsed successfully, otherwise fall back to the current week
     if not end_date:
-        end_date = datetime.datetime.today() + datetime.timedelta(days=4 - datetime.datetime.today().weekday())
+        end_date = today + datetime.timedelta(days=4 - today.weekday())
     end_date = end_date.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
 
     # parse the menu items
     logging.debug('Parse the individual menu items and assign to specific dates')
     menu = {}
-    for (date_key, menu_type), (bb_menu, bb_price) in bbox['menu_items'].items():
+    for (date_key, menu_type), (bb_menu, bb_price) in MENU_BBOX['menu_items'].items():
         # figure out the date(s) for the selected menu item
         if date_key is not None:
             dates = [end_date - datetime.timedelta(end_date.weekday() - date_key)]
@@ -137,8 +362,8 @@ def parse_pdf(f_pdf, campus):
             dates = [end_date - datetime.timedelta(end_date.weekday() - d) for d in range(5)]
 
         # parse the menu item
-        menu_item = pdf.pq('LTTextLineHorizontal:in_bbox("{},{},{},{}")'.format(*bb_menu)).text()
-        price = pdf.pq('LTTextLineHorizontal:in_bbox("{},{},{},{}")'.format(*bb_price)).text()
+        menu_item = lines.text(bb_menu)
+        price = lines.text(bb_price)
         price = [float(p.replace(',', '.')) for p in re.findall('[\d,]+', price)]
 
         # verify whether there is a menu for this day (in case of holidays, ...)
@@ -172,71 +397,192 @@ def parse_pdf(f_pdf, campus):
     return menu
 
 
+class MenuDiff(collections.namedtuple('MenuDiff', ['added', 'changed', 'removed'])):
+    """
+    The (date, campus, menu_type) keys of the menu items that were added, changed, or removed by `store_menu`.
+    """
+
+    @property
+    def affected(self):
+        """
+        Get the menus that were modified.
+
+        Returns:
+            A set of (date, campus) tuples of which at least one menu item was modified.
+        """
+        return {(date, campus) for date, campus, _ in itertools.chain(self.added, self.changed, self.removed)}
+
+    def __bool__(self):
+        return len(self.added) > 0 or len(self.changed) > 0 or len(self.removed) > 0
+
+
 def store_menu(menu):
     """
     Store the given menu items in the database.
 
+    Menu items that were already stored are updated if they were modified, and previously stored menu items for the
+    given dates and campuses that are no longer present in the menu are removed.
+
     Args:
         menu: A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
-    """
-    conn = sqlite3.connect('menu.db')
-    c = conn.cursor()
 
+    Returns:
+        A `MenuDiff` with the keys of the menu items that were added, changed, or removed.
+    """
     logging.debug('Store the menu items in the database')
-    for (date, campus, menu_type), (menu_item, price_student, price_staff) in menu.items():
-        try:
-            c.execute('INSERT INTO menu VALUES (?, ?, ?, ?, ?, ?)',
-                      (date, campus, menu_type, menu_item, price_student, price_staff))
-        except sqlite3.IntegrityError as e:
-            # this menu item is already present in the database
-            logging.debug('Could not insert into the menu database: {}'.format(e))
+    menus = {(date, campus) for date, campus, _ in menu.keys()}
+    with database.transaction() as c:
+        # compare against the previously stored menu items
+        stored = {(date, campus, menu_type): (menu_item, price_student, price_staff)
+                  for date, campus, menu_type, menu_item, price_student, price_staff in
+                  database.get_menu({campus for _, campus in menus}, {date for date, _ in menus})
+                  if (date, campus) in menus}
+        diff = MenuDiff(added={key for key in menu.keys() if key not in stored},
+                        changed={key for key, value in menu.items() if key in stored and stored[key] != value},
+                        removed={key for key in stored.keys() if key not in menu})
+
+        c.executemany('INSERT INTO menu VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(date, campus, type) DO UPDATE SET '
+                      'item = excluded.item, price_student = excluded.price_student, price_staff = excluded.price_staff',
+                      [key + menu[key] for key in diff.added | diff.changed])
+        c.executemany('DELETE FROM menu WHERE date = ? AND campus = ? AND type = ?', diff.removed)
+    logging.debug('Stored menu items: {} added, {} changed, {} removed'.format(
+        len(diff.added), len(diff.changed), len(diff.removed)))
+
+    # only the modified menus have to be retrieved from the database again
+    menu_cache.invalidate(diff.affected)
+
+    return diff
+
+
+def parse_pdf_file(path, campus, today=None):
+    """
+    Parse the menu items from a menu PDF file.
 
-    conn.commit()
-    conn.close()
+    This function is executed in a worker process. The file is memory mapped instead of being read into memory.
 
+    Args:
+        path: The path of the menu PDF.
+        campus: Campus for which the given PDF contains the menu.
+        today: The date relative to which the menu's week is determined. Defaults to today.
 
-def update_menus():
-    """
-    Retrieve the latest menus for campuses CDE, CMI, and CST and store the individual menu items in the database.
+    Returns:
+        A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
     """
-    for campus in ('cde', 'cmi', 'cst'):
-        try:
-            # retrieve the latest menu from the website
-            menu_url = get_menu_url(campus)
-            with download_pdf(menu_url) as f_pdf:
-                # parse the menu from the pdf
-                menu = parse_pdf(f_pdf, campus)
-                # store the menu in the database
-                store_menu(menu)
-        except (requests.HTTPError, LookupError) as e:
-            logging.error('Could not retrieve the menu for campus {}: {}'.format(campus.upper(), e))
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as f_pdf:
+        return parse_pdf(f_pdf, campus, today)
 
 
-def init_database():
+def update_campus(campus, index, timeout):
     """
-    Initialize the menu items database.
+    Retrieve and parse the latest menu for the given campus.
 
-    The database contains a single `menu` table of the form `(date, campus, menu_type, menu_item, price_student, price_staff)`.
+    Args:
+        campus: The campus for which the menu is retrieved.
+        index: The `WeekMenuIndex` of the 'Weekmenu' page.
+        timeout: The maximum number of seconds to wait for the menu to be downloaded and for it to be parsed.
+
+    Returns:
+        A tuple of the menu url, the fetch state of the menu PDF, and a dictionary of the menu in the form
+        (date, campus, menu_type) -> (menu_item, price_student, price_staff), which is None if the menu didn't change.
+        None is returned if the menu PDF was not modified.
+
+    Raises:
+        `requests.RequestException`: The menu could not be retrieved.
+        `LookupError`: The menu url could not be found on the 'Weekmenu' page.
+        `ParseError`: The menu could not be parsed in time or caused the worker process to fail.
     """
-    conn = sqlite3.connect('menu.db')
-    c = conn.cursor()
+    # retrieve the latest menu from the website
+    deadline = time.monotonic() + timeout
+    with metrics.timed('komidabot_stage_seconds', stage='get_menu_url'):
+        menu_url = get_menu_url(campus, index)
+    with metrics.timed('komidabot_stage_seconds', stage='download_pdf'):
+        download = download_pdf(menu_url, deadline=deadline)
+    if download is None:
+        metrics.inc('komidabot_menu_fetches_total', campus=campus, result='not_modified')
+        return None
+    f_pdf, fetch_state = download
+    with f_pdf:
+        if fetch_state['content_hash'] == database.get_fetch_state(menu_url)['content_hash']:
+            logging.debug('Menu for campus {} unchanged'.format(campus.upper()))
+            metrics.inc('komidabot_menu_fetches_total', campus=campus, result='unchanged')
+            return menu_url, fetch_state, None
+
+        # keep the pdf to be able to parse it again later, also if it can't be parsed now
+        try:
+            archive.store(f_pdf, fetch_state['content_hash'], campus, menu_url)
+        except OSError as e:
+            logging.error('Could not archive the menu for campus {}: {}'.format(campus.upper(), e))
+
+        # parse the menu from the pdf in a supervised worker process
+        with metrics.timed('komidabot_stage_seconds', stage='parse_pdf'):
+            menu = _parse_workers.parse(f_pdf.name, campus, timeout)
+        metrics.inc('komidabot_menu_fetches_total', campus=campus, result='downloaded')
+        archive.index_week(fetch_state['content_hash'], campus, menu)
 
-    c.execute('CREATE TABLE menu (date TIMESTAMP, campus TEXT, type TEXT, item TEXT, '
-              'price_student REAL, price_staff REAL, PRIMARY KEY(date, campus, type))')
+    return menu_url, fetch_state, menu
 
-    conn.commit()
-    conn.close()
 
+def update_menus(campuses=('cde', 'cmi', 'cst'), timeout=300):
+    """
+    Retrieve the latest menus for the given campuses and store the individual menu items in the database.
 
-class KomidaUpdate(Job):
+    The menus for all campuses are retrieved and parsed concurrently. Menus that were not modified since they were
+    previously stored are skipped.
 
-    def run(self, slack_client):
-        # create the database if needed
-        if not os.path.exists('menu.db'):
-            init_database()
+    Args:
+        campuses: The campuses for which the menus are updated. Defaults to CDE, CMI, and CST.
+        timeout: The maximum number of seconds to wait for the menu of each campus.
 
-        # update the menu
-        update_menus()
+    Returns:
+        A tuple of a `MenuDiff` with the keys of the menu items that were added, changed, or removed, and the set of
+        campuses for which the menu could not be updated.
+    """
+    diff = MenuDiff(set(), set(), set())
 
-        # expects an iterable
-        return []
+    # the 'Weekmenu' page is only retrieved once for all campuses
+    try:
+        with metrics.timed('komidabot_stage_seconds', stage='weekmenu_index'):
+            index = get_weekmenu_index()
+    except requests.RequestException as e:
+        logging.error("Could not retrieve the 'Weekmenu' page: {}".format(e))
+        for campus in campuses:
+            metrics.inc('komidabot_campus_failures_total', campus=campus, reason='retrieve')
+        return diff, set(campuses)
+
+    deadline = time.monotonic() + timeout
+    futures = [(campus, _download_pool.submit(update_campus, campus, index, timeout)) for campus in campuses]
+    results, failed = [], set()
+    for campus, future in futures:
+        try:
+            result = future.result(max(0, deadline - time.monotonic()))
+            if result is not None:
+                results.append(result)
+            continue
+        except (requests.RequestException, LookupError) as e:
+            logging.error('Could not retrieve the menu for campus {}: {}'.format(campus.upper(), e))
+            reason = 'retrieve'
+        except concurrent.futures.TimeoutError:
+            logging.error('Could not retrieve the menu for campus {}: timed out'.format(campus.upper()))
+            reason = 'timeout'
+        except ParseError as e:
+            logging.error('Could not parse the menu for campus {}: {}'.format(campus.upper(), e))
+            reason = 'parse'
+        except Exception as e:
+            logging.exception('Could not parse the menu for campus {}: {}'.format(campus.upper(), e))
+            reason = 'error'
+        failed.add(campus)
+        metrics.inc('komidabot_campus_failures_total', campus=campus, reason=reason)
+
+    # store the menus of all campuses in a single transaction
+    menu = {}
+    for _, _, campus_menu in results:
+        if campus_menu is not None:
+            menu.update(campus_menu)
+    if len(menu) > 0:
+        with metrics.timed('komidabot_stage_seconds', stage='store_menu'):
+            diff = store_menu(menu)
+    # only remember the menus after they were successfully stored
+    for menu_url, fetch_state, _ in results:
+        database.set_fetch_state(menu_url, **fetch_state)
+
+    return diff, failed
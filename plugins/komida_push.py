@@ -0,0 +1,104 @@
+import collections
+import datetime
+import logging
+
+from rtmbot.core import Job
+
+from .komida_db import database
+from .komida_metrics import metrics
+from .komida_update import CAMPUSES
+
+
+# errors after which the menu can never be posted to the channel
+_CHANNEL_ERRORS = ('channel_not_found', 'is_archived', 'not_in_channel')
+
+
+class KomidaPush(Job):
+
+    def __init__(self, sender, render, update=None, interval=30, until='14:00'):
+        """
+        Initialize the job to post the daily menu to the subscribed channels.
+
+        All subscriptions that are due are handled at once: each menu is rendered only once and is then posted to all
+        subscribed channels through the throttled Slack message queue as bulk messages.
+
+        Args:
+            sender: The `SlackSender` used to post the menus.
+            render: Function that retrieves the menu for a list of campuses and dates as Slack attachments.
+            update: The `KomidaUpdate` job that is refreshed if a subscribed menu is missing.
+            interval: The number of seconds between checks for due subscriptions.
+            until: The time as 'HH:MM' after which the menu is no longer posted on that day.
+        """
+        super().__init__(interval)
+        self.sender = sender
+        self.render = render
+        self.update = update
+        self.until = until
+
+    def run(self, slack_client):
+        with metrics.timed('komidabot_stage_seconds', stage='push'):
+            self.push()
+
+        # expects an iterable
+        return []
+
+    def push(self, now=None):
+        """
+        Post today's menu to all channels whose subscription is due and that didn't receive it yet.
+
+        Args:
+            now: The current `datetime`. Defaults to now.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        # menus are only available on weekdays
+        if now.weekday() >= 5 or now.strftime('%H:%M') >= self.until:
+            return
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        due = collections.defaultdict(list)
+        for channel, campus, time, last_sent in database.get_subscriptions():
+            if time <= now.strftime('%H:%M') and (last_sent is None or last_sent < today):
+                due[channel].append(campus)
+        if len(due) == 0:
+            return
+
+        # retrieve all menus in a single batch, afterwards each campus' menu is a cache hit
+        campuses = sorted({campus for channel_campuses in due.values() for campus in channel_campuses})
+        self.render(campuses, [today])
+        attachments = {campus: self.render([campus], [today]) for campus in campuses}
+
+        missing = [campus for campus in campuses if len(attachments[campus]) == 0]
+        if any(campus in CAMPUSES for campus in missing) and self.update is not None:
+            # the subscriptions for the missing menus are retried on the next run
+            logging.debug('Subscribed menu for campus {} missing, updating...'.format(', '.join(missing).upper()))
+            self.update.refresh(force=True)
+
+        sent = []
+        for channel, channel_campuses in due.items():
+            channel_campuses = [campus for campus in channel_campuses if campus not in missing]
+            if len(channel_campuses) == 0:
+                continue
+            channel_attachments = [attachment for campus in channel_campuses for attachment in attachments[campus]]
+            self.sender.send(channel, '*LUNCH!*', channel_attachments,
+                             coalesce_key=('menu', tuple(attachment['title'] for attachment in channel_attachments)),
+                             on_error=lambda reason, channel=channel: self._failed(channel, reason), bulk=True)
+            sent.extend((channel, campus) for campus in channel_campuses)
+
+        # the menus are marked as sent once queued to avoid posting them twice
+        database.set_subscriptions_sent(sent, today)
+        metrics.inc('komidabot_push_messages_total', len({channel for channel, _ in sent}))
+        logging.debug('Pushed the menu to {} subscribed channels'.format(len({channel for channel, _ in sent})))
+
+    def _failed(self, channel, reason):
+        """
+        Handle a menu that could not be posted to a subscribed channel.
+
+        Args:
+            channel: The subscribed channel.
+            reason: The error reason.
+        """
+        logging.error('Failed to post the subscribed menu to channel {}: {}'.format(channel, reason))
+        if reason in _CHANNEL_ERRORS:
+            logging.info('Unsubscribe channel {}'.format(channel))
+            database.remove_subscription(channel)
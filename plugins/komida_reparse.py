@@ -0,0 +1,96 @@
+"""
+Parse archived menu PDFs again and store the resulting menus in the database.
+
+This is useful to re-extract past menus after the menu PDF layout in `parse_pdf` has been adjusted.
+
+Usage (from the repository root):
+
+    python -m plugins.komida_reparse --since 2017-01-01 --until 2017-12-31 [--campus cmi] [--workers 4]
+"""
+import argparse
+import concurrent.futures
+import datetime
+import logging
+import os
+
+from .komida_archive import archive, get_week
+from .komida_db import database
+from .komida_parser import parse_pdf_file, store_menu
+
+
+def reparse(campuses, start, end, workers=None):
+    """
+    Parse the archived menu PDFs for the given campuses and weeks in parallel and store the menus in the database.
+
+    If multiple PDFs contain the menu of the same week, for example an original and a corrected menu, the menu of the
+    most recently retrieved PDF is stored. The week of each PDF is determined relative to the date at which it was
+    retrieved.
+
+    A running bot keeps serving the menus that it has cached for up to the cache TTL (one hour) after they were parsed
+    again.
+
+    Args:
+        campuses: The campuses for which the menus are parsed.
+        start: The `datetime` of the first week.
+        end: The `datetime` of the last week.
+        workers: The number of worker processes. Defaults to the number of cores.
+
+    Returns:
+        A `MenuDiff` with the keys of the menu items that were added, changed, or removed.
+    """
+    pdfs = database.get_archived_pdfs(campuses, start, end)
+    logging.info('Parse {} archived menu PDFs'.format(len(pdfs)))
+
+    menus = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # the weeks are determined relative to the date at which the PDFs were retrieved instead of today
+        futures = {executor.submit(parse_pdf_file, archive.path(content_hash), campus, retrieved):
+                   (content_hash, campus) for content_hash, campus, _, retrieved in pdfs}
+        for future in concurrent.futures.as_completed(futures):
+            content_hash, campus = futures[future]
+            try:
+                pdf_menu = future.result()
+            except Exception as e:
+                logging.error('Could not parse archived menu {} for campus {}: {}'.format(
+                    content_hash, campus.upper(), e))
+                continue
+            menus[(content_hash, campus)] = pdf_menu
+            # the week might have changed after adjusting the parser
+            database.add_archived_pdf(content_hash, campus, get_week(pdf_menu), None, None)
+
+    # newer menus replace older menus of the same dates regardless of the order in which the workers finished
+    menu = {}
+    for content_hash, campus, _, _ in pdfs:
+        pdf_menu = menus.get((content_hash, campus), {})
+        replaced = {(date, menu_campus) for date, menu_campus, _ in pdf_menu.keys()}
+        menu = {key: value for key, value in menu.items() if key[:2] not in replaced}
+        menu.update(pdf_menu)
+
+    # store all menus in a single transaction
+    return store_menu(menu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default='menu.db', help='the menu database (default: %(default)s)')
+    parser.add_argument('--archive', default='archive', help='the menu PDF archive directory (default: %(default)s)')
+    parser.add_argument('--campus', action='append', choices=['cde', 'cgb', 'cmi', 'cst'],
+                        help='the campus to parse, can be specified multiple times (default: all campuses)')
+    parser.add_argument('--since', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d'), default=datetime.datetime.min,
+                        help='the first week to parse (YYYY-MM-DD)')
+    parser.add_argument('--until', type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%d'), default=datetime.datetime.max,
+                        help='the last week to parse (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='the number of worker processes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    database.open(args.database)
+    archive.root = args.archive
+    diff = reparse(args.campus or ['cde', 'cgb', 'cmi', 'cst'], args.since, args.until, args.workers)
+    logging.info('Stored menu items: {} added, {} changed, {} removed'.format(
+        len(diff.added), len(diff.changed), len(diff.removed)))
+
+
+if __name__ == '__main__':
+    main()
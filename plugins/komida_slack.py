@@ -0,0 +1,190 @@
+import collections
+import logging
+import threading
+import time
+
+from .komida_metrics import metrics
+
+
+class SlackSender:
+
+    def __init__(self, slack_client, rate=1.0, burst=3, global_rate=1.0, global_burst=10, coalesce_window=5.0,
+                 max_retries=3, **message_args):
+        """
+        Initialize the outbound Slack message queue.
+
+        Messages are posted by a background thread so that the RTM loop never waits for the Slack API. The messages
+        to each channel are posted in order and throttled using a per-channel token bucket. Bulk messages, such as the
+        daily menus posted to many channels at once, are additionally throttled using a workspace-wide token bucket so
+        that they don't exceed Slack's rate limit for the whole workspace. Rate limited messages are retried after the
+        delay that Slack requests.
+
+        Args:
+            slack_client: The `SlackClient` used to post the messages.
+            rate: The number of messages per second that can be posted to a single channel.
+            burst: The number of messages that can be posted to a single channel at once.
+            global_rate: The number of bulk messages per second that can be posted to the whole workspace.
+            global_burst: The number of bulk messages that can be posted to the whole workspace at once.
+            coalesce_window: The number of seconds during which identical messages to the same channel are coalesced.
+            max_retries: The number of times a rate limited message is retried.
+            message_args: Additional arguments for all `chat.postMessage` calls, such as `username` and `icon_emoji`.
+        """
+        self.slack_client = slack_client
+        self.rate = rate
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.message_args = message_args
+
+        self._pending = collections.OrderedDict()
+        self._buckets = {}
+        self._global_bucket = (global_burst, time.monotonic())
+        self._recent = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def send(self, channel, text, attachments=None, coalesce_key=None, on_error=None, bulk=False):
+        """
+        Queue a message to be posted to Slack.
+
+        Args:
+            channel: The channel to which the message is posted.
+            text: The text of the message.
+            attachments: Optional attachments of the message.
+            coalesce_key: If given, the message is dropped when a message with the same key was queued for the same
+                          channel within the coalesce window.
+            on_error: Function that is called with the error reason if the message could not be posted.
+            bulk: Whether the message is throttled by the workspace-wide token bucket as well.
+
+        Returns:
+            True if the message was queued, False if it was coalesced with a previous message.
+        """
+        with self._condition:
+            now = time.monotonic()
+            if coalesce_key is not None:
+                # forget old messages
+                self._recent = {key: queued for key, queued in self._recent.items()
+                                if now - queued < self.coalesce_window}
+                if (channel, coalesce_key) in self._recent:
+                    logging.debug('Coalesce message to channel {}'.format(channel))
+                    metrics.inc('komidabot_slack_messages_total', result='coalesced')
+                    return False
+                self._recent[(channel, coalesce_key)] = now
+
+            message = {'text': text, 'on_error': on_error, 'retries': 0, 'not_before': now, 'queued': now,
+                       'bulk': bulk}
+            if attachments is not None:
+                message['attachments'] = attachments
+            self._pending.setdefault(channel, collections.deque()).append(message)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='SlackSender', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+            return True
+
+    def _take_token(self, channel, now, bulk=False):
+        """
+        Take a token from the channel's token bucket, and for bulk messages from the workspace-wide token bucket.
+
+        No token is taken unless all required tokens are available.
+
+        Args:
+            channel: The channel to which a message will be posted.
+            now: The current monotonic time.
+            bulk: Whether the message is a bulk message.
+
+        Returns:
+            0 if the tokens were taken, otherwise the number of seconds until the tokens are available.
+        """
+        tokens, updated = self._buckets.get(channel, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        delay = max(0, (1 - tokens) / self.rate)
+        if bulk:
+            global_tokens, global_updated = self._global_bucket
+            global_tokens = min(self.global_burst, global_tokens + (now - global_updated) * self.global_rate)
+            delay = max(delay, (1 - global_tokens) / self.global_rate)
+            self._global_bucket = (global_tokens - 1 if delay == 0 else global_tokens, now)
+        self._buckets[channel] = (tokens - 1 if delay == 0 else tokens, now)
+
+        return delay
+
+    def _next_message(self):
+        """
+        Wait until a queued message can be posted.
+
+        Returns:
+            A tuple of the channel and the message to post.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = None
+                for channel, messages in self._pending.items():
+                    delay = messages[0]['not_before'] - now
+                    if delay <= 0:
+                        delay = self._take_token(channel, now, messages[0]['bulk'])
+                        if delay == 0:
+                            message = messages.popleft()
+                            if len(messages) == 0:
+                                del self._pending[channel]
+                            return channel, message
+                    wait = delay if wait is None else min(wait, delay)
+
+                self._condition.wait(wait)
+
+    def _run(self):
+        """
+        Post the queued messages.
+        """
+        while True:
+            channel, message = self._next_message()
+            message_args = dict(self.message_args)
+            if 'attachments' in message:
+                message_args['attachments'] = message['attachments']
+            try:
+                with metrics.timed('komidabot_stage_seconds', stage='slack_post'):
+                    response = self.slack_client.api_call('chat.postMessage', channel=channel, text=message['text'],
+                                                          **message_args)
+            except Exception as e:
+                logging.exception('Failed to post to Slack: {}'.format(e))
+                response = {'ok': False, 'error': str(e)}
+
+            if response.get('ok'):
+                metrics.inc('komidabot_slack_messages_total', result='posted')
+                # the time between queueing the message and posting it, including throttling and retries
+                metrics.observe('komidabot_slack_delivery_seconds', time.monotonic() - message['queued'])
+            else:
+                metrics.inc('komidabot_slack_errors_total', reason=response.get('error', 'unknown error'))
+                self._failed(channel, message, response)
+
+    def _failed(self, channel, message, response):
+        """
+        Retry a message that was rate limited, or report the failure.
+
+        Args:
+            channel: The channel to which the message was posted.
+            message: The message that could not be posted.
+            response: The Slack API response.
+        """
+        reason = response.get('error', 'unknown error')
+        if reason == 'ratelimited' and message['retries'] < self.max_retries:
+            headers = {key.lower(): value for key, value in response.get('headers', {}).items()}
+            retry_after = float(headers.get('retry-after', 1))
+            logging.warning('Rate limited by Slack, retry in {} seconds'.format(retry_after))
+            with self._condition:
+                message['retries'] += 1
+                message['not_before'] = time.monotonic() + retry_after
+                self._pending.setdefault(channel, collections.deque()).appendleft(message)
+                self._pending.move_to_end(channel, last=False)
+                self._condition.notify()
+        elif message['on_error'] is not None:
+            try:
+                message['on_error'](reason)
+            except Exception as e:
+                logging.exception('Failed to handle the Slack error: {}'.format(e))
+        else:
+            logging.error('Failed to post to Slack: {}'.format(reason))
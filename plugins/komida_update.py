@@ -0,0 +1,197 @@
+import collections
+import datetime
+import itertools
+import logging
+import random
+import threading
+import time
+
+from rtmbot.core import Job
+
+from .komida_cache import menu_cache
+from .komida_db import database
+from .komida_metrics import metrics
+
+
+# campuses for which the menu is retrieved
+CAMPUSES = ('cde', 'cmi', 'cst')
+
+
+def get_upcoming_dates(today=None):
+    """
+    Get the dates for which the menu should already be available.
+
+    This is the current weekday, or the next Monday during the weekend. From Friday onwards the menu for the next
+    week is expected as well.
+
+    Args:
+        today: The current date. Defaults to today.
+
+    Returns:
+        A list of `datetime` objects.
+    """
+    if today is None:
+        today = datetime.datetime.today()
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+
+    dates = [today] if today.weekday() < 5 else []
+    if today.weekday() >= 4:
+        dates.append(today + datetime.timedelta(days=7 - today.weekday()))
+
+    return dates
+
+
+class KomidaUpdate(Job):
+
+    def __init__(self, min_interval=900, max_interval=21600, min_refresh_interval=600, backoff=300):
+        """
+        Initialize the job to update the menus.
+
+        Menu updates run in a background thread. Concurrent update requests are coalesced into the update that is in
+        progress, and forced updates are rate limited.
+
+        Updates are scheduled adaptively: frequently while the upcoming menus are missing from the database and rarely
+        once all menus are available. Campuses for which the update fails are retried with an exponential backoff.
+
+        Args:
+            min_interval: The number of seconds between scheduled updates while menus are missing.
+            max_interval: The number of seconds between scheduled updates once all menus are available, and the
+                          maximal backoff.
+            min_refresh_interval: The minimal number of seconds between the end of an update and a forced update.
+            backoff: The number of seconds before a campus for which the update failed is retried the first time.
+        """
+        super().__init__(min_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.backoff = backoff
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._callbacks = []
+        self._last_update = None
+        self._next_update = time.time()
+        self._failures = collections.Counter()
+        self._retry_at = {}
+
+    def check(self):
+        """
+        Check whether the next scheduled update is due.
+
+        Returns:
+            True if the next update is due, False if not.
+        """
+        return time.time() >= self._next_update
+
+    def run(self, slack_client):
+        # update the menu in the background
+        self.refresh()
+
+        # expects an iterable
+        return []
+
+    def refresh(self, callback=None, force=False):
+        """
+        Start a background menu update unless an update is already in progress.
+
+        Args:
+            callback: Function without arguments that is called once the update has finished.
+            force: Whether the update is forced by a menu request, in which case the update is skipped if the previous
+                   update finished less than `min_refresh_interval` seconds ago.
+
+        Returns:
+            True if an update is in progress and the callback will be called when it has finished, False if the forced
+            update was skipped.
+        """
+        with self._lock:
+            if self._thread is None:
+                if force and self._last_update is not None and\
+                        time.monotonic() - self._last_update < self.min_refresh_interval:
+                    logging.debug('Skip the forced menu update, the menu was updated recently')
+                    metrics.inc('komidabot_refreshes_total', forced=str(force).lower(), result='skipped')
+                    return False
+
+                metrics.inc('komidabot_refreshes_total', forced=str(force).lower(), result='started')
+                self._thread = threading.Thread(target=self._update, name='KomidaUpdate', daemon=True)
+                self._thread.start()
+            else:
+                metrics.inc('komidabot_refreshes_total', forced=str(force).lower(), result='coalesced')
+            if callback is not None:
+                self._callbacks.append(callback)
+            # the next update is scheduled by the update in progress once it has finished
+            self._next_update = float('inf')
+
+            return True
+
+    def _update(self):
+        """
+        Update the menus, schedule the next update, and notify all waiting callbacks.
+        """
+        try:
+            # skip the campuses that are backing off after a failed update
+            campuses = [campus for campus in CAMPUSES if self._retry_at.get(campus, 0) <= time.time()]
+            if len(campuses) > 0:
+                # the heavy parser dependencies are only loaded once the menu is actually updated
+                from . import komida_parser
+                with metrics.timed('komidabot_stage_seconds', stage='update'):
+                    _, failed = komida_parser.update_menus(campuses)
+                self._update_backoff(campuses, failed)
+            logging.debug('Menu cache statistics: {}'.format(menu_cache.stats()))
+        except Exception as e:
+            logging.exception('Problem while updating the menu: {}'.format(e))
+        finally:
+            with self._lock:
+                self._schedule()
+                callbacks, self._callbacks = self._callbacks, []
+                self._thread = None
+                self._last_update = time.monotonic()
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.exception('Problem after updating the menu: {}'.format(e))
+
+    def _update_backoff(self, campuses, failed):
+        """
+        Reset the backoff for the successfully updated campuses and increase it for the failed campuses.
+
+        Args:
+            campuses: The campuses that were updated.
+            failed: The campuses for which the update failed.
+        """
+        for campus in campuses:
+            if campus in failed:
+                self._failures[campus] += 1
+                delay = min(self.max_interval, self.backoff * 2 ** (self._failures[campus] - 1))
+                self._retry_at[campus] = time.time() + delay * random.uniform(0.8, 1.2)
+                logging.debug('Retry the menu update for campus {} in {:.0f} seconds'.format(campus.upper(), delay))
+            else:
+                self._failures.pop(campus, None)
+                self._retry_at.pop(campus, None)
+
+    def _schedule(self):
+        """
+        Schedule the next update depending on whether the upcoming menus are available.
+
+        While menus are missing the menu is updated frequently, but not at night.
+        """
+        now = datetime.datetime.now()
+        try:
+            dates = get_upcoming_dates(now)
+            stored = {(date, campus) for date, campus, *_ in database.get_menu(CAMPUSES, dates)}
+            missing = any((date, campus) not in stored for date, campus in itertools.product(dates, CAMPUSES))
+        except Exception as e:
+            logging.exception('Could not check for missing menus: {}'.format(e))
+            missing = True
+
+        interval = self.min_interval if missing else self.max_interval
+        next_update = now + datetime.timedelta(seconds=interval * random.uniform(0.9, 1.1))
+        # menus are not published at night
+        if missing and not 6 <= next_update.hour < 22:
+            morning = next_update.replace(hour=6, minute=0, second=0, microsecond=0)
+            next_update = morning if next_update.hour < 6 else morning + datetime.timedelta(days=1)
+            next_update += datetime.timedelta(seconds=random.uniform(0, self.min_interval))
+
+        logging.debug('Next menu update scheduled at {}'.format(next_update.strftime('%A %d %B %H:%M')))
+        self._next_update = next_update.timestamp()
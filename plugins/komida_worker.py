@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import queue
+
+try:
+    import resource
+except ImportError:
+    # memory limits are only supported on Unix
+    resource = None
+
+
+class ParseError(Exception):
+    """
+    The menu PDF could not be parsed by the worker process.
+    """
+    pass
+
+
+class ParseTimeout(ParseError):
+    """
+    The worker process did not parse the menu PDF in time.
+    """
+    pass
+
+
+def _worker_main(conn, memory_limit):
+    """
+    Parse the menu PDFs received over the given connection until it is closed.
+
+    Args:
+        conn: The `multiprocessing.Connection` over which (path, campus) requests are received and (status, result)
+              responses are sent.
+        memory_limit: The maximum address space of the worker process in bytes, or None.
+    """
+    if memory_limit is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    # only the worker process needs the heavy parser dependencies
+    from .komida_parser import parse_pdf_file
+
+    while True:
+        try:
+            path, campus = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(('ok', parse_pdf_file(path, campus)))
+        except MemoryError:
+            conn.send(('error', 'memory limit exceeded'))
+            # start over with a fresh process
+            return
+        except Exception as e:
+            conn.send(('error', '{}: {}'.format(type(e).__name__, e)))
+
+
+class ParseWorker:
+
+    def __init__(self, memory_limit=None):
+        """
+        Initialize a supervised worker process to parse menu PDFs.
+
+        The worker process is started when the first PDF is parsed, and restarted after it has crashed, exceeded its
+        memory limit, or has been terminated because it didn't finish in time.
+
+        Args:
+            memory_limit: The maximum address space of the worker process in bytes, or None for no limit.
+        """
+        self.memory_limit = memory_limit
+
+        self._context = multiprocessing.get_context('spawn')
+        self._process = None
+        self._conn = None
+
+    def _start(self):
+        """
+        Start the worker process.
+        """
+        logging.debug('Start a menu parsing worker process')
+        self._conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(target=_worker_main, args=(child_conn, self.memory_limit),
+                                              name='KomidaParser', daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def stop(self):
+        """
+        Terminate the worker process if it is running.
+        """
+        if self._process is not None:
+            self._conn.close()
+            self._process.terminate()
+            self._process.join()
+            self._process = self._conn = None
+
+    def parse(self, path, campus, timeout):
+        """
+        Parse the menu items from a menu PDF file in the worker process.
+
+        Args:
+            path: The path of the menu PDF.
+            campus: Campus for which the given PDF contains the menu.
+            timeout: The maximum number of seconds to wait for the result.
+
+        Returns:
+            A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
+
+        Raises:
+            `ParseTimeout`: The menu PDF was not parsed in time.
+            `ParseError`: The menu PDF could not be parsed.
+        """
+        if self._process is None or not self._process.is_alive():
+            self.stop()
+            self._start()
+
+        try:
+            self._conn.send((path, campus))
+            if not self._conn.poll(timeout):
+                self.stop()
+                raise ParseTimeout('Parsing took longer than {} seconds'.format(timeout))
+            status, result = self._conn.recv()
+        except (EOFError, OSError) as e:
+            exitcode = self._process.exitcode if self._process is not None else None
+            self.stop()
+            raise ParseError('The worker process stopped unexpectedly (exit code {}): {}'.format(exitcode, e))
+
+        if status != 'ok':
+            raise ParseError(result)
+
+        return result
+
+
+class ParseWorkerPool:
+
+    def __init__(self, size=3, memory_limit=512 * 1024 * 1024):
+        """
+        Initialize a pool of supervised worker processes to parse menu PDFs concurrently.
+
+        Args:
+            size: The number of worker processes.
+            memory_limit: The maximum address space of each worker process in bytes, or None for no limit.
+        """
+        self._workers = queue.Queue()
+        for _ in range(size):
+            self._workers.put(ParseWorker(memory_limit))
+
+    def parse(self, path, campus, timeout):
+        """
+        Parse the menu items from a menu PDF file in an idle worker process.
+
+        Args:
+            path: The path of the menu PDF.
+            campus: Campus for which the given PDF contains the menu.
+            timeout: The maximum number of seconds to wait for the result.
+
+        Returns:
+            A dictionary of the menu in the form (date, campus, menu_type) -> (menu_item, price_student, price_staff).
+
+        Raises:
+            `ParseTimeout`: The menu PDF was not parsed in time.
+            `ParseError`: The menu PDF could not be parsed.
+        """
+        worker = self._workers.get()
+        try:
+            return worker.parse(path, campus, timeout)
+        finally:
+            self._workers.put(worker)
+
+    def stop(self):
+        """
+        Terminate the idle worker processes. They are started again when they parse their next menu PDF.
+        """
+        for worker in list(self._workers.queue):
+            worker.stop()